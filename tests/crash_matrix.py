@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sys
+
+# Short codes for the matrix (the full results are in the JSON file)
+CODES = {
+	'entered': 'Y',
+	'returned': '-',
+	'timeout': 'T',
+	'unavailable': ' ',
+}
+
+def main(argv):
+	'''Merge the results of the LKDTM crash sweep into an arch x crash matrix.
+
+	Usage: crash_matrix.py OUTPUT INPUT...
+
+	Each input is the crash-sweep.json from an architecture's kernel
+	build directory (see tests/test_crash_sweep.py). The merged results
+	are written to OUTPUT and a summary is printed.
+	'''
+	output = argv[1]
+	merged = {}
+
+	for fname in sorted(argv[2:]):
+		if not os.path.exists(fname):
+			# Unexpanded glob (no results at all)
+			continue
+		with open(fname) as f:
+			data = json.load(f)
+		merged[data['arch']] = data
+
+	with open(output, 'w') as f:
+		json.dump(merged, f, indent=1)
+
+	columns = [ (arch, mode) for arch in sorted(merged)
+				 for mode in sorted(merged[arch]['results']) ]
+	crashes = []
+	for (arch, mode) in columns:
+		for crash in merged[arch]['results'][mode]:
+			if crash not in crashes:
+				crashes.append(crash)
+
+	print(f"{'':28}" + ''.join([ f'{arch:>8}' for (arch, mode) in columns ]))
+	print(f"{'':28}" + ''.join([ f'{mode:>8}' for (arch, mode) in columns ]))
+	for crash in crashes:
+		row = ''
+		for (arch, mode) in columns:
+			r = merged[arch]['results'][mode].get(crash, { 'outcome': 'unavailable' })
+			if r['outcome'] == 'entered':
+				row += f"{r['latency']:7.1f}s"
+			else:
+				row += f"{CODES.get(r['outcome'], '?'):>8}"
+		print(f'{crash:28}' + row)
+	print("Entry latency in seconds, - = no entry, T = timeout, blank = unavailable")
+	print(f'Merged results written to {output}')
+
+	return 0 if merged else 1
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
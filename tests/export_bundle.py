@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+import kbuild
+import os
+import sys
+
+def main(argv):
+	'''Build the kernel and export it as a bundle.
+
+	Usage: export_bundle.py [DIR]
+
+	The bundle can be copied to other machines (or shared between
+	test shards on this one) and tested without rebuilding by setting
+	BUNDLE=DIR. If DIR is omitted then the bundle is placed in the
+	bundles/ directory of the kernel build directory.
+	'''
+	if 'BUNDLE' in os.environ:
+		print('>>> Cannot export a bundle whilst testing one (unset BUNDLE)')
+		return 1
+
+	# Resolve DIR before kbuild changes directory
+	dest = os.path.abspath(argv[1]) if len(argv) > 1 else None
+
+	kbuild.config(kgdb=True)
+	kbuild.build()
+	kbuild.export_bundle(dest)
+	return 0
+
+if __name__ == '__main__':
+	try:
+		sys.exit(main(sys.argv))
+	except KeyboardInterrupt:
+		sys.exit(1)
+	sys.exit(127)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import kbuild
+import ktest
+import os
+import shutil
+import statistics
+import sys
+import time
+
+# Printed when the kernel starts and finishes unpacking the initramfs
+# (with BLK_DEV_RAM the start is "Trying to unpack rootfs image as
+# initramfs..."). We use the printk timestamps when there are any because
+# they are not affected by console latency.
+UNPACK_START = r'(?:\[ *([0-9.]+)\] [^\r\n]*)?[Uu]npack[^\r\n]*initramfs'
+UNPACK_END = [
+	r'(?:\[ *([0-9.]+)\] )?Freeing initrd memory',
+	# Not every architecture frees the initrd
+	r'(?:\[ *([0-9.]+)\] )?Freeing unused kernel.*memory',
+]
+
+def get_supported():
+	'''List the formats that both the host and the kernel support.'''
+	with open('.config') as f:
+		config = f.read().splitlines()
+
+	supported = []
+	for (fmt, (cmd, ext, rd)) in kbuild.INITRAMFS_COMPRESSORS.items():
+		if not shutil.which(cmd.split()[0]):
+			print(f'>>> Skipping {fmt} ({cmd.split()[0]} is not installed)')
+		elif rd and f'CONFIG_{rd}=y' not in config:
+			print(f'>>> Skipping {fmt} (kernel has no CONFIG_{rd})')
+		else:
+			supported.append(fmt)
+	return supported
+
+def measure():
+	'''Boot the kernel and time how long it takes to unpack the initramfs.'''
+	qemu = ktest.qemu()
+	try:
+		c = qemu.console
+		c.timeout *= 4
+		c.expect(UNPACK_START)
+		(start, start_stamp) = (time.monotonic(), c.match.group(1))
+		c.expect(UNPACK_END)
+		(end, end_stamp) = (time.monotonic(), c.match.group(1))
+	finally:
+		qemu.close()
+
+	if start_stamp and end_stamp:
+		return float(end_stamp) - float(start_stamp)
+	return end - start
+
+def main(argv):
+	'''Find the fastest initramfs compression for this architecture.
+
+	Usage: initramfs_benchmark.py [RUNS]
+
+	Every format that the host and kernel support is measured (taking
+	the median of RUNS boots) and the fastest is saved in the kernel
+	build directory. kbuild uses it from then on, unless overridden by
+	INITRAMFS_COMPRESSION.
+	'''
+	runs = int(argv[1]) if len(argv) > 1 else 3
+
+	# Enable every decompressor so the kernel only has to be built once
+	rds = [ f'{rd}=y' for (cmd, ext, rd) in kbuild.INITRAMFS_COMPRESSORS.values() if rd ]
+	kbuild.config(kgdb=True, extra_config=rds)
+	kbuild.build()
+
+	results = {}
+	for fmt in get_supported():
+		os.environ['INITRAMFS_COMPRESSION'] = fmt
+		kbuild.build_rootfs()
+		size = os.stat('rootfs.cpio.gz').st_size
+		times = [ measure() for i in range(runs) ]
+		results[fmt] = (statistics.median(times), size)
+
+	del os.environ['INITRAMFS_COMPRESSION']
+	if not results:
+		print('>>> No initramfs compression could be measured')
+		return 1
+
+	print(f"\n>>> {'format':8} {'unpack':>8} {'size':>10}")
+	for (fmt, (seconds, size)) in sorted(results.items(), key=lambda r: r[1][0]):
+		print(f'>>> {fmt:8} {seconds:7.3f}s {size // 1024:9}K')
+
+	best = min(results, key=lambda fmt: results[fmt][0])
+	with open('initramfs-compression', 'w') as f:
+		print(best, file=f)
+	print(f'>>> Saved {best} as the initramfs compression for {kbuild.get_arch()}')
+
+	# Leave the rootfs compressed using the format we chose
+	kbuild.build_rootfs()
+	return 0
+
+if __name__ == '__main__':
+	try:
+		sys.exit(main(sys.argv))
+	except KeyboardInterrupt:
+		sys.exit(1)
+	sys.exit(127)
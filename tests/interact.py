@@ -7,14 +7,15 @@ import sys
 
 def main(argv):
 	kgdb = 'kgdb' in argv[1:]
-	nowait = 'nowait' in argv[1:]
+	warm = 'warm' in argv[1:]
+	nowait = 'nowait' in argv[1:] or warm
 	gfx = 'gfx' in argv[1:] or 'graphics' in argv[1:]
 
 	configs = []
 	args = []
 
 	for arg in argv[1:]:
-		if arg in ('kgdb', 'nowait', 'gfx', 'graphics'):
+		if arg in ('kgdb', 'nowait', 'warm', 'gfx', 'graphics'):
 			continue
 
 		# lowercase= or MixedCased= becomes a kernel option
@@ -35,9 +36,11 @@ def main(argv):
 
 	kbuild.config(kgdb=True, extra_config=configs)
 	kbuild.build()
+	print('>>> ' + str(kbuild.get_tree()))
 	ktest.qemu(interactive=True,
 		   gdb=kgdb,
 		   gfx=gfx,
+		   warm=warm,
 		   append=' '.join(args),
 		   second_uart=kgdb)
 
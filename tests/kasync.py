@@ -0,0 +1,312 @@
+import asyncio
+import functools
+import kbuild
+import ktest
+import os
+import pexpect
+import pytest
+import re
+import warnings
+
+from ktest import WARN_WORDS, FAIL_WORDS, unique_tag
+
+class AsyncChannel(object):
+	'''An asyncio front end for a pexpect spawn.
+
+	Output is drained from the child as soon as it is ready, regardless
+	of whether anyone is currently waiting for it. This means that a
+	single process can supervise many channels (and many guests)
+	without any of them filling up their buffers and stalling.
+
+	The interface mirrors the parts of pexpect used by ktest (expect(),
+	send(), before, after, match and timeout) except that expect() must
+	be awaited.
+	'''
+	def __init__(self, spawn):
+		self.spawn = spawn
+		self.loop = asyncio.get_running_loop()
+		self.timeout = spawn.timeout
+		self.default_timeout = getattr(spawn, 'default_timeout', spawn.timeout)
+		self.before = None
+		self.after = None
+		self.match = None
+		self.eof = False
+		self.data_ready = asyncio.Event()
+
+		# Adopt anything pexpect has already read (for example, if the
+		# guest was launched synchronously)
+		self.buffer = spawn.buffer
+		spawn.buffer = ''
+
+		self.loop.add_reader(spawn.child_fd, self._drain)
+
+	def _drain(self):
+		try:
+			self.buffer += self.spawn.read_nonblocking(self.spawn.maxread, 0)
+		except pexpect.TIMEOUT:
+			return
+		except pexpect.EOF:
+			self.eof = True
+			self.loop.remove_reader(self.spawn.child_fd)
+		self.data_ready.set()
+
+	def send(self, s):
+		return self.spawn.send(s)
+
+	def sendline(self, s=''):
+		return self.spawn.sendline(s)
+
+	async def expect(self, pattern, timeout=-1):
+		'''Wait for one of the patterns to appear in the output.
+
+		As with pexpect, if several patterns match then we pick the
+		one that matches earliest in the output and we return the
+		index of the matching pattern.
+		'''
+		if not isinstance(pattern, list):
+			pattern = [ pattern ]
+		regexes = [ re.compile(p) for p in pattern ]
+		if timeout == -1:
+			timeout = self.timeout
+		# As with pexpect, a timeout of None means wait forever
+		deadline = None if timeout is None else self.loop.time() + timeout
+
+		while True:
+			# Report anything ktest.scan_for_failures() has spotted
+			ktest.check_scan_failure(self.spawn)
+
+			best = None
+			for (i, r) in enumerate(regexes):
+				m = r.search(self.buffer)
+				if m and (best is None or m.start() < best[1].start()):
+					best = (i, m)
+			if best:
+				(i, m) = best
+				self.before = self.buffer[:m.start()]
+				self.after = m.group(0)
+				self.match = m
+				self.buffer = self.buffer[m.end():]
+				return i
+
+			if self.eof:
+				raise pexpect.EOF(f'End of file waiting for {pattern}')
+
+			remaining = None if deadline is None else deadline - self.loop.time()
+			if remaining is not None and remaining <= 0:
+				raise pexpect.TIMEOUT(f'Timeout waiting for {pattern}')
+			self.data_ready.clear()
+			try:
+				await asyncio.wait_for(self.data_ready.wait(), remaining)
+			except asyncio.TimeoutError:
+				pass
+
+	def close(self):
+		if not self.eof:
+			self.loop.remove_reader(self.spawn.child_fd)
+
+class AsyncConsole(AsyncChannel):
+	'''Awaitable equivalents of the console methods bound by ktest.'''
+	def __init__(self, spawn):
+		super().__init__(spawn)
+		self.gdb_on_second_uart = spawn.gdb_on_second_uart
+		self.in_kdb = False
+
+	async def expect_boot(self, skip_early=False):
+		self.timeout *= 4
+		if not skip_early:
+			await self.expect('Linux version.*$')
+		await self.expect('[Uu]npack.*initramfs')
+		await self.expect(['Freeing initrd memory',
+				   'io scheduler.*registered',
+				   'Registered I/O driver kgdboc'])
+		await self.expect('Freeing unused kernel.*memory')
+		self.timeout = self.default_timeout
+
+	async def expect_busybox(self):
+		self.timeout *= 4
+		if 'MINIROOTFS' in os.environ:
+			await self.expect(kbuild.MINIROOTFS_READY)
+			await self.expect_prompt()
+			return
+
+		await self.expect('Starting .*: OK')
+		await self.expect('Welcome to Buildroot')
+		await self.expect(['debian-[^ ]* login:', 'buildroot login:'])
+		self.sendline('root')
+		await self.expect_prompt()
+
+		self.sendline('mount -t debugfs none /sys/kernel/debug')
+		await self.expect_prompt()
+
+	async def expect_clean_output_until(self, prompt):
+		if not isinstance(prompt, list):
+			prompt = [ prompt ]
+
+		prompts = prompt + WARN_WORDS + FAIL_WORDS
+		choice = await self.expect(prompts)
+		while choice >= len(prompt):
+			msg = f'Observed {prompts[choice]} when waiting for {prompt}'
+			if choice >= (len(prompt) + len(WARN_WORDS)):
+				pytest.fail(msg)
+			else:
+				warnings.warn(msg)
+			choice = await self.expect(prompts)
+
+		return choice
+
+	async def expect_prompt(self, sync=True, no_history=False, no_prompt=False):
+		if self.in_kdb:
+			return await self.expect_kdb(sync, no_prompt)
+
+		if sync:
+			self.timeout = self.default_timeout
+			if not no_history:
+				await self.expect_clean_output_until('# ')
+
+			tag = unique_tag('SYNC_SHELL_')
+			self.send(f'echo {tag[:-4]}"{tag[-4:]}"\r')
+			await self.expect_clean_output_until(tag)
+
+		await self.expect_clean_output_until('# ')
+
+	async def expect_kdb(self, sync=True, no_prompt=False):
+		output = None
+
+		if sync and not no_prompt:
+			if 1 == await self.expect_clean_output_until(['kdb>', 'more>']):
+				self.send('q')
+				await self.expect_clean_output_until('kdb>')
+
+		if sync or no_prompt:
+			tag = unique_tag('SYNC_KDB_')
+			self.send(tag + '\r')
+			await self.expect_clean_output_until('Unknown[^\r\n]*' + tag)
+			if no_prompt:
+				output = self.before.replace('\r', '')
+
+		await self.expect_clean_output_until('kdb>')
+
+		return output
+
+	def sendline(self, s=''):
+		if self.in_kdb:
+			self.send(s)
+			self.send('\r')
+		else:
+			super().sendline(s)
+
+	def sysrq(self, ch):
+		self.send('echo {} > /proc/sysrq-trigger\r'.format(ch))
+
+	async def enter_kdb(self, sysrq=True):
+		if sysrq:
+			self.sysrq('g')
+		await self.expect('Entering kdb')
+		await self.expect_kdb()
+		self.in_kdb = True
+		return self
+
+	async def exit_kdb(self, resume=True, shell=True):
+		if resume and self.in_kdb:
+			self.send('q\r')
+			await self.expect_kdb()
+			self.send('go\r')
+			self.in_kdb = False
+		elif not resume:
+			warnings.warn("Cannot exit from kdb (already exited?)")
+
+		if shell:
+			await asyncio.sleep(0.1)
+			await self.expect_prompt(no_history=True)
+
+	async def run_command(self, cmd):
+		enter_kdb = not self.in_kdb
+		output = ''
+
+		try:
+			if enter_kdb:
+				await self.enter_kdb()
+
+			self.sendline(cmd)
+			await self.expect(re.escape(cmd) + '[\r\n]')
+
+			while 1 == await self.expect([r'[\r\n]+[\[\]0-9]*kdb> ', r'[\r\n]+more> ']):
+				output += self.before.replace('\r', '') + '\n'
+				self.send(' ')
+			output += self.before.replace('\r', '')
+
+			if not enter_kdb:
+				await self.expect_prompt(no_prompt=True)
+		finally:
+			if enter_kdb:
+				await self.exit_kdb()
+
+		return output.lstrip('\n')
+
+class AsyncGdb(AsyncChannel):
+	def __init__(self, spawn):
+		super().__init__(spawn)
+		self.connection = spawn.connection
+
+	async def connect_to_target(self):
+		await self.expect_prompt()
+		self.send(f'target extended-remote {self.connection}\r')
+		await self.expect('Remote debugging using')
+		await self.expect_prompt()
+
+	async def expect_prompt(self):
+		await self.expect('[(]gdb[)] ')
+
+		tag = unique_tag('SYNC_GDB_')
+		self.sendline(f'printf "{tag}"')
+		await self.expect(f'{tag}[^\r\n]*[(]gdb[)] ')
+
+class AsyncConsoleWrapper(object):
+	'''Asyncio equivalent of ktest.ConsoleWrapper.
+
+	Wraps a guest launched by ktest.qemu() and drains every channel
+	(the console, gdb and, for single UART systems, the qemu monitor
+	and kdmx) concurrently. The wrapped guest must not be driven using
+	the blocking methods once it has been wrapped.
+	'''
+	def __init__(self, qemu):
+		self.qemu = qemu
+		self.console = AsyncConsole(qemu.console)
+		self.debug = AsyncGdb(qemu.debug) if qemu.debug else None
+
+		self.drains = []
+		if qemu.monitor:
+			self.drains.append(AsyncChannel(qemu.monitor))
+			self.drains.append(AsyncChannel(qemu.monitor.dmx))
+
+	def close(self):
+		for c in [ self.console, self.debug ] + self.drains:
+			if c:
+				c.close()
+		self.qemu.close()
+
+	async def enter_gdb(self, sysrq=True):
+		(console, gdb) = (self.console, self.debug)
+
+		if sysrq:
+			console.sysrq('g')
+		else:
+			gdb.sendline('')
+		await gdb.expect_prompt()
+
+		return (console, gdb)
+
+	async def exit_gdb(self, shell=False):
+		(console, gdb) = (self.console, self.debug)
+
+		gdb.sendline('continue')
+
+		if shell:
+			console.sendline('')
+			await console.expect_prompt()
+
+async def qemu(**kwargs):
+	'''Launch a guest (see ktest.qemu()) and wrap it for use with asyncio.'''
+	loop = asyncio.get_running_loop()
+	qemu = await loop.run_in_executor(None, functools.partial(ktest.qemu, **kwargs))
+	return AsyncConsoleWrapper(qemu)
@@ -1,24 +1,114 @@
+import functools
+import glob
+import hashlib
+import json
+import ksyms
 import os
+import re
+import shutil
 import traceback
 import subprocess
 import sys
+import time
+
+def get_mtime(path):
+	try:
+		return os.stat(path).st_mtime_ns
+	except FileNotFoundError:
+		return None
+
+class KernelTree(object):
+	'''Cached description of the kernel tree (and host) under test.
+
+	Values are computed lazily and then cached for the rest of the
+	session. Anything derived from the kernel Makefile or the .config
+	is recomputed if the file is modified.
+	'''
+	def __init__(self, kernel_dir, arch):
+		self.kernel_dir = kernel_dir
+		self.arch = arch
+		self.kdir = kernel_dir + '/build-{}'.format(arch)
+		self._cache = {}
+
+	def _cached(self, key, stamp, fn):
+		if key in self._cache and self._cache[key][0] == stamp:
+			return self._cache[key][1]
+		value = fn()
+		self._cache[key] = (stamp, value)
+		return value
+
+	def _read_version(self):
+		with open(self.kernel_dir + '/Makefile') as f:
+			for ln in f.readlines():
+				if ln.startswith('VERSION'):
+					version = int(ln.split('=')[1].strip())
+				if ln.startswith('PATCHLEVEL'):
+					patchlevel = int(ln.split('=')[1].strip())
+				if ln.startswith('SUBLEVEL'):
+					sublevel = int(ln.split('=')[1].strip())
+				if ln.startswith('EXTRAVERSION'):
+					extraversion = ln.split('=')[1].strip()
+					break
+
+		return (version, patchlevel, sublevel, extraversion)
+
+	def _hash_config(self):
+		try:
+			with open(self.kdir + '/.config', 'rb') as f:
+				return hashlib.sha256(f.read()).hexdigest()
+		except FileNotFoundError:
+			return None
+
+	@property
+	def version(self):
+		if 'BUNDLE' in os.environ:
+			# There may be no kernel tree at all
+			return tuple(get_bundle_manifest()['version'])
+		makefile = self.kernel_dir + '/Makefile'
+		return self._cached('version', get_mtime(makefile),
+				    self._read_version)
+
+	@property
+	def config_hash(self):
+		config = self.kdir + '/.config'
+		return self._cached('config_hash', get_mtime(config),
+				    self._hash_config)
+
+	@property
+	def host_arch(self):
+		return get_host_arch()
+
+	@property
+	def kvm(self):
+		'''True if the guest can be accelerated using KVM.'''
+		return self.arch == self.host_arch and os.path.exists('/dev/kvm')
+
+	@property
+	def toolchain(self):
+		'''Paths to the (cross) tools, or None if they cannot be found.'''
+		return self._cached('toolchain', get_cross_compile(),
+			lambda: { tool : shutil.which(get_cross_compile(tool))
+				  for tool in ('gcc', 'gdb', 'objcopy', 'readelf') })
+
+	def __str__(self):
+		return '{} kernel v{}.{}.{}{} in {} (host {}{}, config {})'.format(
+			self.arch, *self.version, self.kdir, self.host_arch,
+			', kvm' if self.kvm else '',
+			self.config_hash[:12] if self.config_hash else 'none')
+
+trees = {}
+
+def get_tree():
+	'''Get the (cached) descriptor for the kernel tree under test.'''
+	key = (os.environ['KERNEL_DIR'], get_arch())
+	if key not in trees:
+		trees[key] = KernelTree(*key)
+	return trees[key]
 
 def get_version(short=False):
-	makefile = os.environ['KERNEL_DIR'] + '/Makefile'
-	with open(makefile) as f:
-		for ln in f.readlines():
-			if ln.startswith('VERSION'):
-				version = int(ln.split('=')[1].strip())
-			if ln.startswith('PATCHLEVEL'):
-				patchlevel = int(ln.split('=')[1].strip())
-			if ln.startswith('SUBLEVEL'):
-				sublevel = int(ln.split('=')[1].strip())
-			if ln.startswith('EXTRAVERSION'):
-				extraversion = ln.split('=')[1].strip()
-				break
-
-	return (version, patchlevel, sublevel, extraversion)
+	return get_tree().version
 
+@functools.lru_cache(maxsize=None)
 def get_host_arch():
 	output = subprocess.check_output('uname -m'.split()).decode()
 	if 'aarch64' in output:
@@ -39,7 +129,7 @@ def get_kdir():
 	#       just hack things and rely on the kgdbtest Makefile to
 	#       configure the environment variables we need to get
 	#       things right.
-	return os.environ['KERNEL_DIR'] + '/build-{}'.format(get_arch())
+	return get_tree().kdir
 
 def get_cross_compile(tool=''):
 	if tool:
@@ -52,7 +142,120 @@ def get_cross_compile(tool=''):
 
 	return '' + tool
 
+def parse_cpu_list(cpulist):
+	'''Convert a taskset style CPU list (e.g. 0-3,6) into a list.'''
+	cpus = []
+	for r in cpulist.split(','):
+		r = r.strip()
+		if not r:
+			continue
+		(first, _, last) = r.partition('-')
+		cpus += range(int(first), int(last if last else first) + 1)
+	return sorted(set(cpus))
+
+def format_cpu_list(cpus):
+	return ','.join([ str(c) for c in cpus ])
+
+def get_cpu_budget():
+	'''Split the available CPUs between kernel builds and qemu guests.
 
+	VM_CPUS reserves a list of CPUs for the qemu guests. Everything
+	else is available to the kernel build. If nothing is reserved
+	then both are allowed to use every CPU (which is how things
+	behaved before we started budgeting CPUs).
+
+	Returns a tuple of two lists (build_cpus, vm_cpus).
+	'''
+	cpus = sorted(os.sched_getaffinity(0))
+	vm_cpus = [ c for c in parse_cpu_list(os.environ.get('VM_CPUS', ''))
+			if c in cpus ]
+	build_cpus = [ c for c in cpus if c not in vm_cpus ]
+	if not vm_cpus or not build_cpus:
+		return (cpus, [])
+	return (build_cpus, vm_cpus)
+
+def get_make_jobs():
+	'''Work out how the kernel build should be parallelized.
+
+	If we were launched (directly or indirectly) by a make that is
+	running a jobserver then we must not pass -j since that would
+	cause the kernel build to leave the jobserver and run a private
+	pool of jobs. Instead we let it join the jobserver and share the
+	CPU budget with everything else make is running.
+
+	Otherwise BUILD_JOBS sets the number of jobs explicitly, falling
+	back to one job per CPU in the build budget.
+	'''
+	makeflags = os.environ.get('MAKEFLAGS', '')
+	if '--jobserver-auth' in makeflags or '--jobserver-fds' in makeflags:
+		return ''
+
+	if os.environ.get('BUILD_JOBS'):
+		return '-j {} '.format(int(os.environ['BUILD_JOBS']))
+
+	(build_cpus, vm_cpus) = get_cpu_budget()
+	return '-j {} '.format(len(build_cpus))
+
+def get_ccache():
+	'''Work out where the compiler cache for this architecture lives.
+
+	ccache is used automatically if it is installed (unless NOCCACHE is
+	set). Each architecture has its own cache, shared by every kernel
+	tree and build directory, in $CCACHE_DIR/<arch> or, if CCACHE_DIR is
+	not set, ~/.cache/kgdbtest/ccache/<arch>.
+
+	Returns the cache directory or None if we are not using ccache.
+	'''
+	if 'NOCCACHE' in os.environ or not shutil.which('ccache'):
+		return None
+
+	base = os.environ.get('CCACHE_DIR',
+			os.path.expanduser('~/.cache/kgdbtest/ccache'))
+	return os.path.join(os.path.abspath(base), get_arch())
+
+def get_ccache_options(cache_dir):
+	'''Environment and make variables to compile via ccache.
+
+	Both the target and the host compiler go through the cache (the
+	host tools are rebuilt every time the build directory is
+	cleaned). CCACHE_BASEDIR makes paths within the kernel tree
+	relative so different checkouts of the kernel can share results.
+
+	Returns a tuple of two strings (env, make_vars).
+	'''
+	env = 'CCACHE_DIR={} CCACHE_BASEDIR={} '.format(
+			cache_dir, os.path.abspath(os.environ['KERNEL_DIR']))
+	make_vars = 'CC="ccache {}" HOSTCC="ccache gcc" '.format(
+			get_cross_compile('gcc'))
+	return (env, make_vars)
+
+def get_ccache_stats(cache_dir):
+	'''Read the ccache counters (or None if ccache cannot tell us).'''
+	try:
+		output = subprocess.check_output(['ccache', '--print-stats'],
+				env=dict(os.environ, CCACHE_DIR=cache_dir),
+				stderr=subprocess.DEVNULL).decode()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+	stats = {}
+	for ln in output.splitlines():
+		(key, _, value) = ln.partition('\t')
+		if value.strip().isdigit():
+			stats[key] = int(value)
+	return stats
+
+def report_ccache(cache_dir, before):
+	'''Print the cache hits and misses since before was captured.'''
+	after = get_ccache_stats(cache_dir)
+	if before is None or after is None:
+		return
+
+	delta = lambda k: after.get(k, 0) - before.get(k, 0)
+	hits = delta('direct_cache_hit') + delta('preprocessed_cache_hit')
+	misses = delta('cache_miss')
+	rate = 100 * hits / (hits + misses) if hits + misses else 0
+	print(f'>>> ccache: {hits} hits, {misses} misses ({rate:.0f}% hit rate) in {cache_dir}')
 
 def run(cmd, failmsg=None):
 	'''Run a command (synchronously) raising an exception on
@@ -68,6 +271,103 @@ def run(cmd, failmsg=None):
 		else:
 			raise Exception
 
+def merge_config(fname, options):
+	'''Apply a list of config options to a .config file in a single pass.
+
+	Options are strings of the form NAME=value where the CONFIG_ prefix
+	is optional and NAME=n disables an option. Options that are already
+	present in the file are replaced, the rest are appended. This has
+	the same effect as the corresponding scripts/config --enable,
+	--disable and --set-val options.
+	'''
+	merged = {}
+	for opt in options:
+		(name, value) = opt.split('=', 1)
+		if not name.startswith('CONFIG_'):
+			name = 'CONFIG_' + name
+		if value == 'n':
+			merged[name] = f'# {name} is not set'
+		else:
+			merged[name] = f'{name}={value}'
+
+	try:
+		with open(fname) as f:
+			lines = f.read().splitlines()
+	except FileNotFoundError:
+		lines = []
+
+	output = []
+	for ln in lines:
+		if ln.startswith('CONFIG_'):
+			name = ln.split('=')[0]
+		elif ln.startswith('# CONFIG_') and ln.endswith(' is not set'):
+			name = ln.split()[1]
+		else:
+			name = None
+
+		if name in merged:
+			output.append(merged.pop(name))
+		else:
+			output.append(ln)
+	output += merged.values()
+
+	# Replace (rather than rewrite) the file in case it is linked to
+	# a bundle
+	with open(fname + '.tmp', 'w') as f:
+		for ln in output:
+			print(ln, file=f)
+	os.replace(fname + '.tmp', fname)
+
+def get_config_key(defconfig, options):
+	'''Hash everything that contributes to the resolved .config.
+
+	Returns None if the kernel is not a git tree since, without git,
+	we have no cheap way to tell if the Kconfig files have changed.
+	'''
+	kernel_dir = os.environ['KERNEL_DIR']
+	try:
+		head = subprocess.check_output(
+			['git', '-C', kernel_dir, 'rev-parse', 'HEAD'],
+			stderr=subprocess.DEVNULL).decode().strip()
+		dirty = subprocess.check_output(
+			['git', '-C', kernel_dir, 'status', '--porcelain', '-uno',
+			 '--', ':(glob)**/Kconfig*', ':(glob)**/configs/**'],
+			stderr=subprocess.DEVNULL).decode().splitlines()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+	# Kconfig probes the compiler so the toolchain is an input too
+	gcc = get_tree().toolchain['gcc']
+
+	# Without a defconfig we start from whatever .config we already have
+	base = defconfig if defconfig else get_tree().config_hash
+
+	h = hashlib.sha256()
+	for part in [ get_arch(), str(base), head, str(gcc), str(get_mtime(gcc)) ] + \
+		    [ '{} {}'.format(d, get_mtime(kernel_dir + '/' + d[3:])) for d in dirty ] + \
+		    options:
+		h.update(part.encode() + b'\0')
+	return h.hexdigest()
+
+KCONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'kconfig')
+
+def get_config_fragment(name):
+	'''Read the options from one of the fragments in kconfig/.
+
+	Fragments use the same syntax as .config so they can be written by
+	copying lines from a working .config. The options are returned in
+	the form used by merge_config().
+	'''
+	options = []
+	with open(os.path.join(KCONFIG_DIR, name + '.config')) as f:
+		for ln in f.read().splitlines():
+			m = re.match('# CONFIG_([A-Za-z0-9_]+) is not set', ln)
+			if m:
+				options.append(m.group(1) + '=n')
+			elif ln.startswith('CONFIG_'):
+				options.append(ln[len('CONFIG_'):])
+	return options
+
 def config(kgdb=False, extra_config=None):
 	kdir = get_kdir()
 	try:
@@ -76,14 +376,25 @@ def config(kgdb=False, extra_config=None):
 		pass
 	os.chdir(kdir)
 
+	if 'BUNDLE' in os.environ:
+		import_bundle(os.environ['BUNDLE'])
+		check_bundle_config(extra_config)
+		return
+
 	if 'NOCONFIG' in os.environ or 'NOBUILD' in os.environ :
 		return
 
 	arch = get_arch()
 	defconfig = 'defconfig'
-	postconfig = ''
+	options = []
 	if 'NOWERROR' not in os.environ:
-		postconfig = '--enable WERROR'
+		options.append('WERROR=y')
+	if 'MINIROOTFS' in os.environ:
+		# The minimal rootfs relies on the kernel to populate /dev
+		options.append('DEVTMPFS=y')
+	rd = INITRAMFS_COMPRESSORS[get_initramfs_compression()][2]
+	if rd:
+		options.append(f'{rd}=y')
 	if 'NODEFCONFIG' in os.environ:
 		defconfig = None
 	elif 'arm' == arch:
@@ -93,69 +404,435 @@ def config(kgdb=False, extra_config=None):
 		#       (and the corresponding qemu launch command) would
 		#       be very welcome.
 		defconfig = 'malta_kvm_defconfig generic/64r6.config'
-		postconfig += ' --enable CPU_MIPS64_R6 --enable MIPS_CPS'
-		postconfig += ' --enable BLK_DEV_INITRD'
+		options += [ 'CPU_MIPS64_R6=y', 'MIPS_CPS=y', 'BLK_DEV_INITRD=y' ]
 
 		# MIPS sets FRAME_WARN to 1024 by default and that causes
 		# trouble with WERROR. Let's increase the default!
-		postconfig += ' --set-val FRAME_WARN 2048'
+		options.append('FRAME_WARN=2048')
 	elif 'riscv' == arch:
-		postconfig += ' --disable STRICT_KERNEL_RWX'
-		postconfig += ' --disable STRICT_MODULE_RWX'
+		options += [ 'STRICT_KERNEL_RWX=n', 'STRICT_MODULE_RWX=n' ]
 	elif 'x86' == arch:
 		defconfig = 'x86_64_defconfig'
 
-	if defconfig:
-		run('make -C .. O=$PWD {}'.format(defconfig),
-			'Cannot configure kernel (wrong directory)')
-
-	if postconfig:
-		run('../scripts/config ' + postconfig,
-			'Cannot enable {} specific features'.format(arch))
+	if 'MINICONFIG' in os.environ and defconfig:
+		# Build only what the tests need (see kconfig/). This
+		# replaces the defconfig but the options above (and below)
+		# are still applied on top.
+		defconfig = 'allnoconfig'
+		options += get_config_fragment('common') + get_config_fragment(arch)
 
 	if kgdb:
 		# TODO (v4.17): Needed in linux-next at present
 		#               (and harmless to unaffected kernels)
-		run('../scripts/config ' +
-                        '--enable RUNTIME_TESTING_MENU',
-			'Cannot enable RUNTIME_TESTING_MENU')
-
-		run('../scripts/config ' +
-			'--enable DEBUG_INFO ' +
-			'--enable DEBUG_INFO_DWARF_TOOLCHAIN_DEFAULT ' +
-			'--enable DEBUG_FS ' +
-                        '--enable KALLSYMS_ALL ' +
-			'--enable MAGIC_SYSRQ ' +
-			'--enable KGDB --enable KGDB_TESTS ' +
-                        '--enable KGDB_KDB --enable KDB_KEYBOARD ' +
-                        '--enable LKDTM ' +
-                        '--enable SECURITY_LOCKDOWN_LSM ',
-			'Cannot configure kgdb extensions')
+		options.append('RUNTIME_TESTING_MENU=y')
+
+		options += [
+			'DEBUG_INFO=y',
+			'DEBUG_INFO_DWARF_TOOLCHAIN_DEFAULT=y',
+			'DEBUG_FS=y',
+			'KALLSYMS_ALL=y',
+			'MAGIC_SYSRQ=y',
+			'KGDB=y', 'KGDB_TESTS=y',
+			'KGDB_KDB=y', 'KDB_KEYBOARD=y',
+			'LKDTM=y',
+			'SECURITY_LOCKDOWN_LSM=y',
+			'VIRTIO_MENU=y', 'VIRTIO_CONSOLE=y',
+			'VIRTIO_PCI=y', 'VIRTIO_MMIO=y',
+		]
 
 	self_test = False
 	if self_test:
-		run('../scripts/config ' +
-                        '--enable PROVE_LOCKING ' +
-			'--enable DEBUG_ATOMIC_SLEEP ',
-			'Cannot enable PROVE_LOCKING and DEBUG_ATOMIC_SLEEP')
+		options += [ 'PROVE_LOCKING=y', 'DEBUG_ATOMIC_SLEEP=y' ]
 
 	if extra_config:
-		with open('.config', 'a') as f:
-			for config in extra_config:
-				if config.startswith('CONFIG_'):
-					print(config, file=f)
-				else:
-					print(f'CONFIG_{config}', file=f)
+		options += extra_config
+
+	# If we have resolved exactly this set of inputs before then we
+	# can reuse the result and skip the (slow) calls to make.
+	key = get_config_key(defconfig, options)
+	cached = f'config-cache/{key}.config'
+	if key and os.path.exists(cached):
+		print(f'+ cp {cached} .config')
+		with open(cached) as f:
+			new_config = f.read()
+		try:
+			with open('.config') as f:
+				old_config = f.read()
+		except FileNotFoundError:
+			old_config = None
+		# Don't touch .config unless it changes (keeps make quiet)
+		if new_config != old_config:
+			shutil.copyfile(cached, '.config.tmp')
+			os.replace('.config.tmp', '.config')
+		return
+
+	if defconfig:
+		run('make -C .. O=$PWD {}'.format(defconfig),
+			'Cannot configure kernel (wrong directory)')
+
+	print('+ merge_config .config ' + ' '.join(options))
+	merge_config('.config', options)
 
 	run('make olddefconfig',
 		'Cannot finalize kernel configuration')
 
+	if key:
+		os.makedirs('config-cache', exist_ok=True)
+		shutil.copyfile('.config', cached)
+
+def get_build_id(fname):
+	'''Get the GNU build ID of an ELF file (or None if it has none).'''
+	try:
+		output = subprocess.check_output(
+			[get_cross_compile('readelf'), '-n', fname],
+			stderr=subprocess.DEVNULL).decode()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+	m = re.search('Build ID: ([0-9a-f]+)', output)
+	return m.group(1) if m else None
+
+def get_gdb_index_options():
+	'''gdb options to share the (build ID keyed) index cache.
+
+	Loading the debug info for a kernel is slow because gdb must index
+	it before it can do anything. With the index cache enabled gdb saves
+	the index, named after the build ID of the vmlinux, and reuses it
+	next time the same vmlinux is loaded. The cache directory is
+	relative to the kernel build directory.
+	'''
+	return ' -iex "set index-cache directory gdb-index"' + \
+	       ' -iex "set index-cache on"'
+
+def index_vmlinux():
+	'''Prime the gdb index cache for vmlinux.
+
+	Doing this as part of the build means the first kgdb fixture to
+	launch gdb does not have to pay the cost of indexing.
+	'''
+	build_id = get_build_id('vmlinux')
+	if not build_id or not get_tree().toolchain['gdb']:
+		return
+	if os.path.exists(f'gdb-index/{build_id}.gdb-index'):
+		return
+
+	os.makedirs('gdb-index', exist_ok=True)
+
+	# Looking up a symbol ensures the index is complete before gdb
+	# exits. This is an optimization so we don't fail the build if
+	# it doesn't work.
+	cmd = get_cross_compile('gdb') + ' -batch -nx' + \
+		get_gdb_index_options() + \
+		' -ex "info address start_kernel" vmlinux'
+	print('+ ' + cmd)
+	if os.system(cmd) != 0:
+		print('Cannot index vmlinux (gdb will be slow to start)')
+
+def index_symbols():
+	'''Generate a host side symbol index from System.map.'''
+	print('+ ksyms.generate System.map System.map.idx')
+	ksyms.generate('System.map', 'System.map.idx')
+
+def get_symbols():
+	'''Get the symbol index for the kernel under test (see ksyms.py).'''
+	kdir = get_kdir()
+	if get_mtime(kdir + '/System.map.idx') is None or \
+	   get_mtime(kdir + '/System.map.idx') < get_mtime(kdir + '/System.map'):
+		ksyms.generate(kdir + '/System.map', kdir + '/System.map.idx')
+	return ksyms.SymbolIndex(kdir + '/System.map.idx')
+
+def get_build_fingerprint():
+	'''Describe everything that contributes to the build output.
+
+	Returns a dictionary (so we can report what changed between builds)
+	or None if the kernel is not a git tree.
+	'''
+	kernel_dir = os.environ['KERNEL_DIR']
+	try:
+		tree = subprocess.check_output(
+			['git', '-C', kernel_dir, 'rev-parse', 'HEAD^{tree}'],
+			stderr=subprocess.DEVNULL).decode().strip()
+		dirty = subprocess.check_output(
+			['git', '-C', kernel_dir, 'status', '--porcelain', '-uno'],
+			stderr=subprocess.DEVNULL).decode().splitlines()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+	# Renames are reported as "R  old -> new"
+	dirty = [ d[3:].split(' -> ')[-1] for d in dirty ]
+
+	gcc = get_tree().toolchain['gcc']
+	if 'MINIROOTFS' in os.environ:
+		rootfs = get_busybox()
+	else:
+		rootfs = get_buildroot_rootfs()
+
+	return {
+		'tree': tree,
+		'dirty': { d: get_mtime(kernel_dir + '/' + d) for d in dirty },
+		'config': get_tree().config_hash,
+		'toolchain': '{} {}'.format(gcc, get_mtime(gcc) if gcc else None),
+		'rootfs': '{} {}'.format(rootfs, get_mtime(rootfs)),
+		'overlay': hash_tree(OVERLAY_DIR),
+		'initramfs': get_initramfs_compression(),
+		'modules': 'ROOTFS_MODULES' in os.environ,
+	}
+
+def get_build_changes(fingerprint):
+	'''List the reasons we need to rebuild (an empty list if we don't).'''
+	if fingerprint is None:
+		return [ 'kernel is not a git tree' ]
+
+	for output in ('vmlinux', 'rootfs.cpio.gz'):
+		if not os.path.exists(output):
+			return [ f'{output} is missing' ]
+
+	try:
+		with open('build-fingerprint.json') as f:
+			old = json.load(f)
+	except (FileNotFoundError, ValueError):
+		return [ 'no record of previous build' ]
+
+	changes = [ f'{k} changed' for k in fingerprint
+			if k != 'dirty' and old.get(k) != fingerprint[k] ]
+	files = set(old.get('dirty', {}).items()) ^ set(fingerprint['dirty'].items())
+	changes += [ f'{f} changed' for f in sorted(set([ f for (f, m) in files ])) ]
+	return changes
+
+def hash_tree(path):
+	'''Hash the names, modes and contents of everything below path.'''
+	h = hashlib.sha256()
+	for (dirpath, dirnames, filenames) in os.walk(path):
+		dirnames.sort()
+		for name in sorted(dirnames + filenames):
+			fname = os.path.join(dirpath, name)
+			h.update(os.path.relpath(fname, path).encode() + b'\0')
+			if os.path.islink(fname):
+				h.update(b'-> ' + os.readlink(fname).encode() + b'\0')
+			elif os.path.isfile(fname):
+				h.update(oct(os.stat(fname).st_mode).encode() + b'\0')
+				with open(fname, 'rb') as f:
+					h.update(hashlib.sha256(f.read()).digest())
+	return h.hexdigest()
+
+def prune_cache(pattern, keep):
+	'''Remove all but the most recently used files matching pattern.'''
+	files = sorted(glob.glob(pattern), key=get_mtime, reverse=True)
+	for fname in files[keep:]:
+		os.remove(fname)
+
+# Ways to compress the initramfs: (command, file extension, config option).
+# lz4 must use the legacy format and xz must use CRC32 (or no) checks
+# because that is all the kernel decompressors support.
+INITRAMFS_COMPRESSORS = {
+	'none': ('cat', 'cpio', None),
+	'gzip': ('gzip -c', 'cpio.gz', 'RD_GZIP'),
+	'lz4': ('lz4 -l -c', 'cpio.lz4', 'RD_LZ4'),
+	'lzo': ('lzop -c', 'cpio.lzo', 'RD_LZO'),
+	'zstd': ('zstd -q -c', 'cpio.zst', 'RD_ZSTD'),
+	'xz': ('xz --check=crc32 -c', 'cpio.xz', 'RD_XZ'),
+}
+
+def get_initramfs_compression():
+	'''Choose how to compress the initramfs.
+
+	INITRAMFS_COMPRESSION overrides the choice. Otherwise we use the
+	fastest format found by the last benchmark for this architecture
+	(see tests/initramfs_benchmark.py), falling back to gzip.
+	'''
+	fmt = os.environ.get('INITRAMFS_COMPRESSION')
+	if not fmt:
+		try:
+			with open(get_kdir() + '/initramfs-compression') as f:
+				fmt = f.read().strip()
+		except FileNotFoundError:
+			fmt = 'gzip'
+	if fmt not in INITRAMFS_COMPRESSORS:
+		raise Exception(f'Unknown initramfs compression: {fmt}')
+	return fmt
+
+def get_initramfs_ext():
+	return INITRAMFS_COMPRESSORS[get_initramfs_compression()][1]
+
+def compress_initramfs(cpio, fname):
+	'''Compress cpio (and remove it) to make fname.'''
+	cmd = INITRAMFS_COMPRESSORS[get_initramfs_compression()][0]
+	run(f'{cmd} < {cpio} > {fname}.tmp',
+		f'Cannot compress {cpio}')
+	os.remove(cpio)
+	os.rename(fname + '.tmp', fname)
+
+def get_buildroot_rootfs():
+	return '{}/buildroot/{}/images/rootfs.cpio.xz'.format(
+			os.environ.get('KGDBTEST_DIR', ''), get_arch())
+
+def get_busybox():
+	'''Find the static busybox used to make the minimal rootfs.
+
+	BUSYBOX can be used to provide a busybox for the guest architecture.
+	Otherwise we look for busybox on the PATH (which will only work if
+	the guest and host architectures match).
+	'''
+	busybox = os.environ.get('BUSYBOX')
+	if not busybox and get_arch() == get_host_arch():
+		busybox = shutil.which('busybox')
+	if not busybox:
+		raise Exception('Cannot find busybox for the minimal rootfs (set BUSYBOX)')
+
+	output = subprocess.check_output(
+		[get_cross_compile('readelf'), '-l', busybox],
+		stderr=subprocess.DEVNULL).decode()
+	if 'interpreter' in output:
+		raise Exception(f'{busybox} is not statically linked')
+
+	return os.path.realpath(busybox)
+
+# Files (such as the guest agent) that are added to every rootfs
+OVERLAY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'overlay')
+
+# Printed by the minimal rootfs once the shell is ready for input
+MINIROOTFS_READY = 'kgdbtest: minirootfs ready'
+
+MINIROOTFS_INIT = f'''#!/bin/sh
+/bin/busybox --install -s
+export PATH=/sbin:/usr/sbin:/bin:/usr/bin HOME=/root PS1='# '
+mount -t proc none /proc
+mount -t sysfs none /sys
+mount -t devtmpfs none /dev
+mount -t debugfs none /sys/kernel/debug
+[ -x /etc/init.d/S99kgdbtest-agent ] && /etc/init.d/S99kgdbtest-agent start
+cd /root
+echo "{MINIROOTFS_READY}"
+while true
+do
+	setsid cttyhack sh
+done
+'''
+
+MINIROOTFS_LIST = '''
+dir /dev 0755 0 0
+nod /dev/console 0600 0 0 c 5 1
+dir /bin 0755 0 0
+dir /sbin 0755 0 0
+dir /usr 0755 0 0
+dir /usr/bin 0755 0 0
+dir /usr/sbin 0755 0 0
+dir /etc 0755 0 0
+dir /proc 0755 0 0
+dir /sys 0755 0 0
+dir /tmp 1777 0 0
+dir /root 0700 0 0
+file /bin/busybox {busybox} 0755 0 0
+slink /bin/sh busybox 0777 0 0
+file /init {init} 0755 0 0
+'''
+
+def get_mini_rootfs():
+	'''Generate a (cached) minimal rootfs containing only busybox.
+
+	This is much smaller than the buildroot rootfs (so it unpacks
+	quickly) and it goes straight to a root shell without any init
+	scripts or login prompt. It is packed using the kernel's own
+	gen_init_cpio.
+	'''
+	busybox = get_busybox()
+	h = hashlib.sha256()
+	for part in (busybox, str(get_mtime(busybox)), MINIROOTFS_INIT, MINIROOTFS_LIST):
+		h.update(part.encode() + b'\0')
+	mini = f'rootfs-cache/mini-{h.hexdigest()[:16]}.{get_initramfs_ext()}'
+	if os.path.exists(mini):
+		return mini
+
+	os.makedirs('rootfs-cache', exist_ok=True)
+	with open('rootfs-cache/mini-init', 'w') as f:
+		f.write(MINIROOTFS_INIT)
+	with open('rootfs-cache/mini.list', 'w') as f:
+		f.write(MINIROOTFS_LIST.format(busybox=busybox,
+				init=os.path.abspath('rootfs-cache/mini-init')))
+	run('usr/gen_init_cpio rootfs-cache/mini.list > rootfs-cache/mini.cpio',
+		'Cannot generate minimal rootfs')
+	compress_initramfs('rootfs-cache/mini.cpio', mini)
+	prune_cache('rootfs-cache/mini-*.cpio*', len(INITRAMFS_COMPRESSORS))
+	return mini
+
+def get_base_rootfs():
+	'''Get the rootfs as a (cached) compressed archive.
+
+	Unless MINIROOTFS is set this is the buildroot rootfs. It is
+	recompressed using the fastest format to unpack (see
+	get_initramfs_compression()) which matters for the slower TCG
+	guests.
+	'''
+	if 'MINIROOTFS' in os.environ:
+		return get_mini_rootfs()
+
+	xz = get_buildroot_rootfs()
+	base = f'rootfs-cache/base-{get_mtime(xz)}.{get_initramfs_ext()}'
+	if os.path.exists(base):
+		return base
+
+	os.makedirs('rootfs-cache', exist_ok=True)
+	run(f'unxz -c {xz} > rootfs-cache/base.cpio',
+		'Cannot decompress rootfs')
+	compress_initramfs('rootfs-cache/base.cpio', base)
+	prune_cache('rootfs-cache/base-*.cpio*', len(INITRAMFS_COMPRESSORS))
+	return base
+
+def get_overlay(srcdir, name):
+	'''Pack a directory into a (cached) initramfs overlay.
+
+	The overlay is named after a hash of the files it contains. Configs
+	that produce the same modules (or rebuilds that do not change them)
+	share the overlay rather than repacking it. Returns None if the
+	directory is empty.
+	'''
+	if not os.path.isdir(srcdir) or not os.listdir(srcdir):
+		return None
+
+	overlay = 'rootfs-cache/{}-{}.{}'.format(name, hash_tree(srcdir)[:16],
+						 get_initramfs_ext())
+	if os.path.exists(overlay):
+		print(f'+ # reusing {overlay}')
+		os.utime(overlay)
+		return overlay
+
+	os.makedirs('rootfs-cache', exist_ok=True)
+	tmp = os.path.abspath(f'rootfs-cache/{name}.cpio')
+	run(f'(cd {srcdir}; find . | cpio -H newc -R 0:0 -oF {tmp})',
+		f'Cannot pack {srcdir}')
+	compress_initramfs(tmp, overlay)
+	prune_cache(f'rootfs-cache/{name}-*.cpio*', 8)
+	return overlay
+
+def build_rootfs():
+	'''Assemble rootfs.cpio.gz from the base rootfs and the overlays.
+
+	The kernel will unpack concatenated archives so there is no need
+	to repack the base rootfs to add the overlays to it. The kernel
+	also detects the compression from the contents so rootfs.cpio.gz
+	keeps its name whatever the compression.
+
+	No test needs the kernel modules so, unless ROOTFS_MODULES is set,
+	they are left out to keep the rootfs small and quick to unpack.
+	'''
+	parts = [ get_base_rootfs() ]
+	overlays = [ (OVERLAY_DIR, 'overlay') ]
+	if 'ROOTFS_MODULES' in os.environ:
+		overlays.append(('mod-rootfs', 'modules'))
+	for (srcdir, name) in overlays:
+		overlay = get_overlay(srcdir, name)
+		if overlay:
+			parts.append(overlay)
+	run('cat {} > rootfs.cpio.gz.tmp'.format(' '.join(parts)),
+		'Cannot assemble rootfs')
+	os.replace('rootfs.cpio.gz.tmp', 'rootfs.cpio.gz')
+
 last_config = None
 
 def build():
 	global last_config
 
-	if 'NOBUILD' in os.environ:
+	if 'NOBUILD' in os.environ or 'BUNDLE' in os.environ:
 		return
 
 	# This is a quick and dirty bit of build avoidance. If the .config is
@@ -167,21 +844,261 @@ def build():
 		return
 	last_config = new_config
 
-	make = 'make -s -j `nproc` '
+	# Even with nothing to do make takes a long time to walk a kernel
+	# tree. If nothing has changed since the last build then we can skip
+	# make (and the rest of the build) entirely.
+	fingerprint = get_build_fingerprint()
+	changes = get_build_changes(fingerprint)
+	if not changes:
+		print('>>> Build is up to date')
+		return
+	try:
+		os.remove('build-fingerprint.json')
+	except FileNotFoundError:
+		pass
+
+	# Changing the initramfs compression (e.g. after running
+	# initramfs_benchmark.py) or adding/removing the modules only
+	# requires the rootfs to be repacked
+	if set(changes) <= { 'initramfs changed', 'modules changed' }:
+		print('>>> Repacking rootfs because ' + ', '.join(changes))
+		build_rootfs()
+		with open('build-fingerprint.json', 'w') as f:
+			json.dump(fingerprint, f, indent=1)
+		return
+	print('>>> Building because ' + ', '.join(changes))
+
+	make = 'make -s ' + get_make_jobs()
+	(build_cpus, vm_cpus) = get_cpu_budget()
+	if vm_cpus:
+		# Keep the build away from the CPUs reserved for the guests
+		make = 'taskset -c {} '.format(format_cpu_list(build_cpus)) + make
 	if 'NICEBUILD' in os.environ:
 		# Ensure everything the spreads across all CPUs treads lightly
 		make = 'nice ' + make
+	cache_dir = get_ccache()
+	if cache_dir:
+		os.makedirs(cache_dir, exist_ok=True)
+		(env, make_vars) = get_ccache_options(cache_dir)
+		make = env + make + make_vars
+		stats = get_ccache_stats(cache_dir)
 
+	detach_bundle()
+	start = time.monotonic()
 	run(make + 'all',
 		'Cannot compile kernel')
+	print('>>> Kernel build took {:.1f}s'.format(time.monotonic() - start))
+	if cache_dir:
+		report_ccache(cache_dir, stats)
+	# Install into an empty directory so the overlay contains only the
+	# modules from this build
+	print('+ rm -rf mod-rootfs')
+	shutil.rmtree('mod-rootfs', ignore_errors=True)
 	run(make + 'modules_install ' +
 		'INSTALL_MOD_PATH=$PWD/mod-rootfs INSTALL_MOD_STRIP=1',
 		'Cannot install kernel modules')
-	run('unxz -c $KGDBTEST_DIR/buildroot/{}/images/rootfs.cpio.xz > rootfs.cpio'
-			.format(get_arch()),
-		'Cannot decompress rootfs')
-	run('(rm -rf mod-rootfs/*; cd mod-rootfs; find . | cpio -H newc -AoF ../rootfs.cpio)',
-		'Cannot copy kernel modules into rootfs')
-	# Compressing with xz would be expensive, gzip is enough here
-	run('gzip -f rootfs.cpio',
-		'Cannot recompress rootfs')
+
+	build_rootfs()
+
+	index_vmlinux()
+	index_symbols()
+
+	if fingerprint:
+		with open('build-fingerprint.json', 'w') as f:
+			json.dump(fingerprint, f, indent=1)
+
+def get_kernel_image():
+	'''The kernel image that qemu boots (relative to the build directory).'''
+	return {
+		'arm': 'arch/arm/boot/zImage',
+		'arm64': 'arch/arm64/boot/Image',
+		'mips': 'vmlinux',
+		'riscv': 'arch/riscv/boot/Image',
+		'x86': 'arch/x86/boot/bzImage',
+	}[get_arch()]
+
+def get_dtb():
+	'''The device tree that qemu boots with (or None if qemu provides it).'''
+	if get_arch() != 'arm':
+		return None
+	if get_version() < (6, 5):
+		return 'arch/arm/boot/dts/vexpress-v2p-ca15-tc1.dtb'
+	return 'arch/arm/boot/dts/arm/vexpress-v2p-ca15-tc1.dtb'
+
+# Bump this if the layout of a bundle changes incompatibly
+BUNDLE_FORMAT = 1
+
+def get_bundle_files():
+	'''List the files (relative to the build directory) that go in a bundle.'''
+	files = [ get_kernel_image(), 'vmlinux', 'rootfs.cpio.gz', '.config',
+		  'System.map', 'System.map.idx' ]
+	if get_dtb():
+		files.append(get_dtb())
+	build_id = get_build_id('vmlinux')
+	if build_id and os.path.exists(f'gdb-index/{build_id}.gdb-index'):
+		files.append(f'gdb-index/{build_id}.gdb-index')
+	return sorted(set(files))
+
+def link_or_copy(src, dst):
+	'''Hard link src to dst (copying if they are on different filesystems).'''
+	os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+	if os.path.exists(dst):
+		if os.path.samefile(src, dst):
+			return
+		os.remove(dst)
+	try:
+		os.link(src, dst)
+	except OSError:
+		shutil.copy2(src, dst)
+
+def get_kernel_release():
+	with open('include/config/kernel.release') as f:
+		return f.read().strip()
+
+def get_bundle_name():
+	return f'kgdbtest-{get_arch()}-{get_kernel_release()}-{get_tree().config_hash[:12]}'
+
+def export_bundle(dest=None):
+	'''Copy everything needed to run the tests into a bundle directory.
+
+	The bundle contains the kernel image, vmlinux, the dtb (if any),
+	the rootfs, the resolved .config, the symbol and gdb indexes and a
+	manifest.json describing the build. Running the tests with BUNDLE
+	pointing at the directory uses these files instead of configuring
+	and building a kernel (see import_bundle()).
+
+	The files are copied rather than linked because the next build
+	may rewrite some of them in place. The copies are read-only.
+
+	By default the bundle is named after the architecture, kernel
+	release and config and is placed in the bundles/ directory of the
+	build directory.
+
+	Returns the path to the bundle.
+	'''
+	if not dest:
+		dest = os.path.join('bundles', get_bundle_name())
+	dest = os.path.abspath(dest)
+	if os.path.exists(dest):
+		if not os.path.exists(os.path.join(dest, 'manifest.json')):
+			raise Exception(f'{dest} exists and is not a bundle')
+		print(f'+ rm -rf {dest}')
+		shutil.rmtree(dest)
+
+	files = {}
+	for fname in get_bundle_files():
+		print(f'+ cp {fname} {dest}/{fname}')
+		os.makedirs(os.path.dirname(os.path.join(dest, fname)), exist_ok=True)
+		shutil.copy2(fname, os.path.join(dest, fname))
+		# Bundles are shared so nothing should write to them
+		os.chmod(os.path.join(dest, fname), 0o444)
+		files[fname] = os.stat(fname).st_size
+
+	release = get_kernel_release()
+	manifest = {
+		'format': BUNDLE_FORMAT,
+		'arch': get_arch(),
+		'version': get_version(),
+		'release': release,
+		'config': get_tree().config_hash,
+		'initramfs': get_initramfs_compression(),
+		'fingerprint': get_build_fingerprint(),
+		'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+		'files': files,
+	}
+	with open(os.path.join(dest, 'manifest.json'), 'w') as f:
+		json.dump(manifest, f, indent=1)
+
+	print(f'>>> Exported {release} ({get_arch()}) to {dest}')
+	return dest
+
+@functools.lru_cache(maxsize=None)
+def read_bundle_manifest(bundle):
+	with open(os.path.join(bundle, 'manifest.json')) as f:
+		manifest = json.load(f)
+
+	if manifest.get('format') != BUNDLE_FORMAT:
+		raise Exception(f'{bundle} has unsupported format {manifest.get("format")}')
+	if manifest['arch'] != get_arch():
+		raise Exception(f'{bundle} is for {manifest["arch"]} (not {get_arch()})')
+	return manifest
+
+def get_bundle_manifest():
+	'''Get the manifest of the bundle named by BUNDLE.'''
+	return read_bundle_manifest(os.path.abspath(os.environ['BUNDLE']))
+
+def import_bundle(bundle):
+	'''Populate the build directory from a bundle.
+
+	Files are hard linked (falling back to a copy if the bundle is on
+	another filesystem) so any number of build directories, for
+	example one for each test shard, can share a single bundle
+	cheaply. Hard links also preserve the modification times which
+	keeps the warm standby snapshots and the parked gdb valid between
+	shards. The next build in this directory removes the links before
+	it writes anything (see detach_bundle()).
+	'''
+	bundle = os.path.abspath(bundle)
+	manifest = read_bundle_manifest(bundle)
+	for fname in manifest['files']:
+		link_or_copy(os.path.join(bundle, fname), fname)
+
+	# The build directory no longer matches its own build
+	try:
+		os.remove('build-fingerprint.json')
+	except FileNotFoundError:
+		pass
+
+	# Remember what we linked so detach_bundle() can undo it
+	with open('bundle.json', 'w') as f:
+		json.dump({ 'bundle': bundle, 'files': list(manifest['files']) }, f, indent=1)
+
+def detach_bundle():
+	'''Remove any links to a bundle that import_bundle() left behind.
+
+	Our own writers replace files rather than rewriting them but the
+	kernel build makes no such promise. Unlinking the bundled files
+	before building ensures a build can never modify a bundle through
+	the links (and the kernel build simply recreates them).
+	'''
+	try:
+		with open('bundle.json') as f:
+			imported = json.load(f)
+	except FileNotFoundError:
+		return
+
+	print('>>> Detaching from bundle ' + imported['bundle'])
+	for fname in imported['files']:
+		# Leave alone anything that has already been replaced (such
+		# as the .config we are about to build)
+		try:
+			if os.path.samefile(fname, os.path.join(imported['bundle'], fname)):
+				os.remove(fname)
+		except FileNotFoundError:
+			pass
+	os.remove('bundle.json')
+
+def check_bundle_config(options):
+	'''Skip the current test if the bundle lacks a config it requires.
+
+	Tests that need a variant config (e.g. test_zzzz_lockdown.py) pass
+	extra_config to config(). A bundle contains a single kernel so such
+	tests can only run if the bundled .config already satisfies them.
+	'''
+	if not options:
+		return
+
+	with open('.config') as f:
+		config = f.read().splitlines()
+	for opt in options:
+		(name, value) = opt.split('=', 1)
+		if not name.startswith('CONFIG_'):
+			name = 'CONFIG_' + name
+		if value == 'n':
+			ok = not any(ln.startswith(name + '=') for ln in config)
+		else:
+			ok = f'{name}={value}' in config
+		if not ok:
+			# Only tests pass extra_config so pytest is available
+			import pytest
+			pytest.skip(f'Bundle was not built with {opt}')
@@ -0,0 +1,254 @@
+'''
+Host side model of the kdb line editor.
+
+This mirrors kdb_getchar(), kdb_read() and the command history handling
+in kdb_local() closely enough to predict the command that kdb will run
+for any sequence of keystrokes. Keystrokes the model cannot predict
+raise Unpredictable.
+
+Tab completion is modelled using the host side symbol index (see
+ksyms.py). This assumes kallsyms contains the same symbols as
+System.map, which holds for the kgdb test configs since they enable
+KALLSYMS_ALL.
+'''
+
+# From kernel/debug/kdb/kdb_private.h and kdb_main.c
+CMD_BUFLEN = 200
+HISTORY_COUNT = 32
+
+# The longest line kdb_read() will accept (space is reserved for the
+# newline and the NUL terminator)
+MAX_LINE = CMD_BUFLEN - 2
+
+# Keys as returned by kdb_getchar()
+HOME = '\x01'
+LEFT = '\x02'
+DEL = '\x04'
+END = '\x05'
+RIGHT = '\x06'
+BACKSPACE = '\x08'
+TAB = '\x09'
+DOWN = '\x0e'
+UP = '\x10'
+
+# Keystrokes as sent by a terminal
+ESC_UP = '\x1b[A'
+ESC_DOWN = '\x1b[B'
+ESC_RIGHT = '\x1b[C'
+ESC_LEFT = '\x1b[D'
+ESC_HOME = '\x1b[1~'
+ESC_DEL = '\x1b[3~'
+ESC_END = '\x1b[4~'
+INVALID3 = '\x1b[]'
+INVALID4 = '\x1b[1]'
+
+EDITS = (
+	ESC_UP, ESC_DOWN, ESC_RIGHT, ESC_LEFT, ESC_HOME, ESC_DEL, ESC_END,
+	INVALID3, INVALID4,
+	HOME, LEFT, DEL, END, RIGHT, BACKSPACE, DOWN, UP,
+)
+
+class Unpredictable(Exception):
+	pass
+
+def handle_escape(buf):
+	'''Python version of kdb_handle_escape().
+
+	Returns 0 if the sequence is incomplete, -1 if it is not an escape
+	sequence or the translated key.
+	'''
+	last = buf[-1]
+	if len(buf) == 1:
+		if last == '\x1b':
+			return 0
+	elif len(buf) == 2:
+		if last == '[':
+			return 0
+	elif len(buf) == 3:
+		if last in 'ABCD':
+			return ord({ 'A': UP, 'B': DOWN, 'C': RIGHT, 'D': LEFT }[last])
+		if last in '134':
+			return 0
+	elif len(buf) == 4:
+		if last == '~' and buf[2] in '134':
+			return ord({ '1': HOME, '3': DEL, '4': END }[buf[2]])
+	return -1
+
+def random_keystrokes(rng, length, alphabet='wxyz', tab_rate=0.03, history=True):
+	'''Generate a random list of keystrokes (one key or run of keys per op).'''
+	edits = EDITS
+	if not history:
+		edits = [ e for e in EDITS if e not in (ESC_UP, ESC_DOWN, UP, DOWN) ]
+	ops = []
+	for i in range(length):
+		r = rng.random()
+		if r < 0.5:
+			ops.append(rng.choice(alphabet + ' '))
+		elif r < 0.55:
+			# Long runs will fill the command buffer
+			ops.append(rng.choice(alphabet) * rng.randint(50, 250))
+		elif r < 1 - tab_rate:
+			ops.append(rng.choice(edits))
+		else:
+			ops.append(TAB)
+	return ops
+
+class LineEditor(object):
+	'''Model of the kdb command line (and its history).
+
+	feed() accepts raw keystrokes (including escape sequences) and
+	returns the list of commands kdb will execute as a result. If symbols
+	(a ksyms.SymbolIndex) is not provided then tab completion cannot be
+	predicted.
+
+	The history ring mirrors cmd_hist[], cmd_head, cmd_tail and cmdptr
+	from kdb_main.c. Since we cannot see what was typed before the model
+	was created the history starts out unknown. prime() must be used
+	to fill the history with known values before any history keys are
+	modelled.
+	'''
+	def __init__(self, symbols=None):
+		self.symbols = symbols
+		self.line = ''
+		self.cursor = 0
+		self.tab = 0
+		self.pending = ''
+		self.last_char_was_cr = False
+		self.forget()
+
+	def forget(self):
+		'''Mark the history as unknown.'''
+		self.hist = [ None ] * HISTORY_COUNT
+		(self.head, self.tail, self.ptr) = (0, 1, 0)
+		self.primed = False
+
+	def prime(self, lines):
+		'''Record that lines (at least HISTORY_COUNT-1 of them) were run.
+
+		Once this many commands have been run the history ring is
+		full so we know the exact state of the ring regardless of
+		what happened before.
+		'''
+		assert len(lines) >= HISTORY_COUNT - 1
+		self.hist = [ '' ] + list(lines[-(HISTORY_COUNT - 1):])
+		(self.head, self.tail, self.ptr) = (0, 1, 0)
+		self.primed = True
+		self.line = ''
+		self.cursor = 0
+		self.tab = 0
+
+	def keys(self, s):
+		'''Translate raw input into keys (see kdb_getchar()).'''
+		for ch in s:
+			# Strip the LF from CRLF
+			if self.last_char_was_cr and ch == '\n':
+				self.last_char_was_cr = False
+				continue
+			self.last_char_was_cr = (ch == '\r')
+
+			self.pending += ch
+			key = handle_escape(self.pending)
+			if key == 0:
+				continue
+			if key < 0:
+				key = self.pending[1] if len(self.pending) == 2 else self.pending[0]
+			else:
+				key = chr(key)
+			self.pending = ''
+			yield key
+
+	def feed(self, s):
+		executed = []
+		for key in self.keys(s):
+			cmd = self.key(key)
+			if cmd is not None:
+				executed.append(cmd)
+		return executed
+
+	def key(self, key):
+		'''Handle a single key, returns the command if one is executed.'''
+		if key != TAB:
+			self.tab = 0
+
+		if key == BACKSPACE:
+			if self.cursor > 0:
+				self.line = self.line[:self.cursor-1] + self.line[self.cursor:]
+				self.cursor -= 1
+		elif key in '\r\n':
+			return self.execute()
+		elif key == DEL:
+			self.line = self.line[:self.cursor] + self.line[self.cursor+1:]
+		elif key == HOME:
+			self.cursor = 0
+		elif key == END:
+			self.cursor = len(self.line)
+		elif key == LEFT:
+			self.cursor = max(0, self.cursor - 1)
+		elif key == RIGHT:
+			self.cursor = min(len(self.line), self.cursor + 1)
+		elif key in (UP, DOWN):
+			self.history(key)
+		elif key == TAB:
+			self.complete()
+		elif key == '\x7f':
+			raise Unpredictable('DEL (0x7f) is not modelled')
+		elif ord(key) >= 32 and len(self.line) < MAX_LINE:
+			self.line = self.line[:self.cursor] + key + self.line[self.cursor:]
+			self.cursor += 1
+
+		return None
+
+	def complete(self):
+		'''Tab completion (the second tab lists symbols instead).'''
+		if self.symbols is None:
+			raise Unpredictable('no symbols for tab completion')
+		self.tab = min(self.tab + 1, 2)
+		if self.tab == 2:
+			return
+
+		word = self.line[:self.cursor].split(' ')[-1]
+		completion = self.symbols.common_prefix(word)
+		if not completion:
+			return
+		extra = completion[len(word):MAX_LINE - len(self.line) + len(word)]
+		self.line = self.line[:self.cursor] + extra + self.line[self.cursor:]
+		self.cursor += len(extra)
+
+	def history(self, key):
+		if self.ptr == self.head:
+			self.hist[self.head] = self.line
+
+		if self.head != self.tail:
+			if key == UP and self.ptr != self.tail:
+				self.ptr = (self.ptr + HISTORY_COUNT - 1) % HISTORY_COUNT
+			elif key == DOWN and self.ptr != self.head:
+				self.ptr = (self.ptr + 1) % HISTORY_COUNT
+			if self.hist[self.ptr] is None:
+				raise Unpredictable('history is unknown')
+			self.line = self.hist[self.ptr]
+
+		self.cursor = len(self.line)
+
+	def execute(self):
+		cmd = self.line
+		if cmd:
+			self.hist[self.head] = cmd
+			self.head = (self.head + 1) % HISTORY_COUNT
+			if self.head == self.tail:
+				self.tail = (self.tail + 1) % HISTORY_COUNT
+		self.ptr = self.head
+
+		self.line = ''
+		self.cursor = 0
+		return cmd
+
+	def unknown(self, cmd):
+		'''Predict whether kdb will report cmd as an unknown command.
+
+		This assumes the first word of cmd is not the name of a kdb
+		command.
+		'''
+		words = cmd.split()
+		if not words or not words[0][0].isalpha():
+			return False
+		return self.symbols is None or words[0] not in self.symbols
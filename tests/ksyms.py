@@ -0,0 +1,160 @@
+import mmap
+import os
+import struct
+
+# File layout (all little endian):
+#
+#   header:  magic, number of symbols, (padding)
+#   symbols: address, name offset, name length, type (sorted by address)
+#   names:   index into symbols (sorted by name)
+#   strings: the symbol names (not terminated)
+#
+MAGIC = b'KSYMIDX1'
+HEADER = struct.Struct('<8sII')
+SYMBOL = struct.Struct('<QIHcx')
+NAME = struct.Struct('<I')
+
+def generate(system_map, fname):
+	'''Convert a System.map into a sorted, memory mappable index.'''
+	symbols = []
+	with open(system_map) as f:
+		for ln in f.readlines():
+			fields = ln.split()
+			if len(fields) != 3:
+				continue
+			symbols.append((int(fields[0], 16), fields[2], fields[1]))
+	symbols.sort()
+
+	strings = bytearray()
+	records = bytearray()
+	for (addr, name, typ) in symbols:
+		encoded = name.encode()
+		records += SYMBOL.pack(addr, len(strings), len(encoded), typ.encode())
+		strings += encoded
+
+	by_name = sorted(range(len(symbols)), key=lambda i: (symbols[i][1], i))
+
+	# Replace the index rather than rewriting it. The old index may
+	# still be mapped (or linked into a bundle).
+	with open(fname + '.tmp', 'wb') as f:
+		f.write(HEADER.pack(MAGIC, len(symbols), 0))
+		f.write(records)
+		for i in by_name:
+			f.write(NAME.pack(i))
+		f.write(strings)
+	os.replace(fname + '.tmp', fname)
+
+class SymbolIndex(object):
+	'''Host side symbol lookup for the kernel under test.
+
+	Symbols can be looked up by address (binary search on the address
+	table) or by name and prefix (binary search on the name table)
+	without sending anything to the target.
+
+	Addresses are reported as they appear in System.map. If the kernel
+	has been relocated (e.g. KASLR) then relocate() can be used to teach
+	the index the runtime address of any symbol and all lookups are
+	adjusted to match.
+	'''
+	def __init__(self, fname):
+		with open(fname, 'rb') as f:
+			self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		(magic, self.count, _) = HEADER.unpack_from(self.map, 0)
+		assert magic == MAGIC
+		self.symbols = HEADER.size
+		self.names = self.symbols + self.count * SYMBOL.size
+		self.strings = self.names + self.count * NAME.size
+		self.offset = 0
+
+	def __len__(self):
+		return self.count
+
+	def __contains__(self, name):
+		try:
+			self.address(name)
+			return True
+		except KeyError:
+			return False
+
+	def _symbol(self, i):
+		(addr, name, length, typ) = SYMBOL.unpack_from(
+				self.map, self.symbols + i * SYMBOL.size)
+		name = self.map[self.strings + name:self.strings + name + length]
+		return (addr, name.decode(), typ.decode())
+
+	def _by_name(self, i):
+		(sym,) = NAME.unpack_from(self.map, self.names + i * NAME.size)
+		return self._symbol(sym)
+
+	def _search_name(self, name):
+		'''Find the first position in the name table that is >= name.'''
+		(lo, hi) = (0, self.count)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self._by_name(mid)[1] < name:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo
+
+	def relocate(self, name, address):
+		'''Record the runtime address of a symbol.'''
+		self.offset = 0
+		self.offset = address - self.address(name)
+
+	def address(self, name):
+		'''Get the address of a symbol (raises KeyError if not found).'''
+		i = self._search_name(name)
+		if i < self.count:
+			(addr, sym, typ) = self._by_name(i)
+			if sym == name:
+				return addr + self.offset
+		raise KeyError(name)
+
+	def lookup(self, address):
+		'''Find the symbol containing address.
+
+		Returns a (name, offset) tuple, or None if the address is
+		before the first symbol.
+		'''
+		address -= self.offset
+		(lo, hi) = (0, self.count)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self._symbol(mid)[0] <= address:
+				lo = mid + 1
+			else:
+				hi = mid
+		if lo == 0:
+			return None
+		(addr, name, typ) = self._symbol(lo - 1)
+		return (name, address - addr)
+
+	def complete(self, prefix):
+		'''List the (unique) symbol names that start with prefix.'''
+		names = []
+		i = self._search_name(prefix)
+		while i < self.count:
+			name = self._by_name(i)[1]
+			if not name.startswith(prefix):
+				break
+			if not names or names[-1] != name:
+				names.append(name)
+			i += 1
+		return names
+
+	def common_prefix(self, prefix):
+		'''Find the longest common prefix of the symbols that start with prefix.
+
+		This is what kdb's tab completion inserts. Returns None if no
+		symbol starts with prefix.
+		'''
+		first = self._search_name(prefix)
+		last = self._search_name(prefix + '\x7f') - 1
+		if last < first:
+			return None
+		(a, b) = (self._by_name(first)[1], self._by_name(last)[1])
+		n = 0
+		while n < min(len(a), len(b)) and a[n] == b[n]:
+			n += 1
+		return a[:n]
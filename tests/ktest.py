@@ -1,9 +1,16 @@
+import fcntl
+import functools
+import hashlib
 import kbuild
 import os
 import pexpect
 import random
+import re
+import socket
+import shutil
 import string
 import sys
+import tempfile
 import time
 import warnings
 import pytest
@@ -25,6 +32,10 @@ FAIL_WORDS = [
 	'breakpoint remove failed',
 ]
 
+# FAIL_WORDS are also checked as output arrives (see scan_for_failures())
+FAIL_WORDS_RE = re.compile('|'.join(FAIL_WORDS))
+SCAN_CONTEXT = 2048
+
 def unique_tag(prefix=''):
 	"""
 	Generate an short string that can be used to synchronize the prompt.
@@ -36,6 +47,26 @@ def unique_tag(prefix=''):
 	return prefix + ''.join(
 		    [random.choice(string.ascii_uppercase) for i in range(8)])
 
+class Transcript(object):
+	'''A file-like object that remembers the most recent output.
+
+	Attach it as the logfile_read of a pexpect channel to keep a window
+	of recent output that can be reported when a long running test
+	fails.
+	'''
+	def __init__(self, size=16384):
+		self.size = size
+		self.data = ''
+
+	def write(self, s):
+		self.data = (self.data + s)[-self.size:]
+
+	def flush(self):
+		pass
+
+	def __str__(self):
+		return self.data
+
 def expect_boot(self, bootloader=(), skip_early=False, skip_late=False, want_gdb_message=False):
 	for msg in bootloader:
 		self.expect(msg)
@@ -104,6 +135,12 @@ def expect_busybox(self):
 	# for userspace to come up. It is restored by expect_prompt().
 	self.timeout *= 4
 
+	# The minimal rootfs has no init scripts or login
+	if 'MINIROOTFS' in os.environ:
+		self.expect(kbuild.MINIROOTFS_READY)
+		self.expect_prompt()
+		return
+
 	self.expect('Starting .*: OK')
 	self.expect('Welcome to Buildroot')
 	self.expect(['debian-[^ ]* login:', 'buildroot login:'])
@@ -153,10 +190,20 @@ def expect_prompt(self, sync=True, no_history=False):
 
 def sysrq(self, ch):
 	"""
-	Use the shell to run a sysrq command
+	Use the shell (or the guest agent, if there is one) to run a sysrq
+	command
 	"""
+	if self.agent:
+		self.agent.sysrq(ch)
+		return
 	self.send('echo {} > /proc/sysrq-trigger\r'.format(ch))
 
+def load(self, *specs):
+	"""
+	Generate background load in the guest (see Load)
+	"""
+	return Load(self, specs)
+
 def expect_kdb(self, sync=True, no_prompt=False):
 	"""
 	Manage the pager until we get a kdb prompt (or timeout)
@@ -234,6 +281,42 @@ def run_command_kdb(self, cmd):
 
 	return output.lstrip('\n')
 
+def measure_command_kdb(self, cmd, inject=None):
+	'''Run a kdb command and measure the console throughput.
+
+	Returns a tuple of the number of characters received and the time
+	taken to receive them (measured from the echo of the command to the
+	next kdb prompt). Characters are counted after decoding, so for
+	anything other than ASCII they are not bytes. If inject is set then
+	it is typed, without a carriage return, as soon as the first line
+	of output (not counting the echo) arrives.
+	The caller is responsible for collecting whatever kdb makes of the
+	injected characters once the prompt returns.
+
+	The pager is not handled; it is expected to have been disabled
+	(set LINES 10000) by the caller.
+	'''
+	self.sendline(cmd)
+	self.expect(re.escape(cmd) + '[\r\n]')
+
+	start = time.monotonic()
+	nchars = 0
+	prompt = r'[\r\n]+[\[\]0-9]*kdb> '
+	if inject:
+		# The echo may leave a line ending behind so we must wait
+		# for a line with something on it
+		if 0 == self.expect([prompt, '[^\r\n]+[\r\n]']):
+			warnings.warn(f'{cmd} finished before input could be injected')
+			return (len(self.before) + len(self.after),
+				time.monotonic() - start)
+		nchars += len(self.before) + len(self.after)
+		self.send(inject)
+
+	self.expect(prompt)
+	nchars += len(self.before) + len(self.after)
+
+	return (nchars, time.monotonic() - start)
+
 def get_regs_kdb(self):
 	"""Fetch and parse the regsister set.
 
@@ -326,6 +409,83 @@ def gdb_expect_prompt(self):
 	self.sendline(f'printf "{tag}"')
 	self.expect(f'{tag}[^\r\n]*[(]gdb[)] ')
 
+def scanning_read_nonblocking(self, size=1, timeout=-1):
+	'''read_nonblocking() that watches for FAIL_WORDS as data arrives.
+
+	expect_clean_output_until() only checks for FAIL_WORDS when it is
+	called. Scanning every read means they are spotted during a plain
+	expect() too, failing the test at once rather than waiting for the
+	expect() to time out.
+
+	Failures are recorded on the channel and reported by the next
+	expect() (see check_scan_failure()). If we are already inside an
+	expect() then we report them straight away. We cannot raise from
+	here otherwise since the read may come from somewhere that cannot
+	propagate exceptions (such as the asyncio callbacks in kasync).
+	'''
+	data = self.raw_read_nonblocking(size, timeout)
+	text = self.scan_tail + data
+	# Offset of text[0] within everything read from the channel
+	base = self.scan_offset - len(self.scan_tail)
+	self.scan_offset += len(data)
+	self.scan_tail = text[-SCAN_CONTEXT:]
+
+	for m in FAIL_WORDS_RE.finditer(text):
+		# Each match is only reported once (allows the test to clean
+		# up) and anything seen whilst scanning was disabled is not
+		# reported later.
+		if base + m.end() <= self.scan_seen:
+			continue
+		self.scan_seen = base + m.end()
+		# Keep the first failure until it has been reported
+		if self.scan_enabled and not self.scan_failure:
+			context = text[max(0, m.start() - SCAN_CONTEXT // 2):]
+			self.scan_failure = f'Observed {m.group(0)}:\n{context}'
+
+	if self.scan_expecting:
+		check_scan_failure(self)
+	return data
+
+def check_scan_failure(channel):
+	'''Fail the test if scanning has observed any FAIL_WORDS.'''
+	msg = getattr(channel, 'scan_failure', None)
+	if msg:
+		channel.scan_failure = None
+		pytest.fail(msg)
+
+def scanning_expect(expect):
+	'''Wrap an expect method so it reports failures spotted whilst scanning.'''
+	@functools.wraps(expect)
+	def wrapper(self, *args, **kwargs):
+		check_scan_failure(self)
+		self.scan_expecting = True
+		try:
+			return expect(*args, **kwargs)
+		finally:
+			self.scan_expecting = False
+	return wrapper
+
+def scan_for_failures(channel):
+	'''Check everything read from channel for FAIL_WORDS.
+
+	Tests that deliberately provoke a fail word can set
+	channel.scan_enabled to False. Calling this again for a channel
+	that is already being scanned (such as a warm gdb) resets it.
+	'''
+	if not hasattr(channel, 'raw_read_nonblocking'):
+		channel.raw_read_nonblocking = channel.read_nonblocking
+		channel.read_nonblocking = MethodType(scanning_read_nonblocking, channel)
+		# expect() is implemented using expect_list()
+		for name in ('expect_list', 'expect_exact'):
+			setattr(channel, name,
+				MethodType(scanning_expect(getattr(channel, name)), channel))
+	channel.scan_tail = ''
+	channel.scan_offset = 0
+	channel.scan_seen = 0
+	channel.scan_enabled = True
+	channel.scan_failure = None
+	channel.scan_expecting = False
+
 def bind_methods(c, d):
 	# TODO: Can we use introspection to find methods to bind?
 	c.expect_boot = MethodType(expect_boot, c)
@@ -333,12 +493,14 @@ def bind_methods(c, d):
 	c.expect_clean_output_until = MethodType(expect_clean_output_until, c)
 	c.expect_prompt = MethodType(expect_prompt, c)
 	c.sysrq = MethodType(sysrq, c)
+	c.load = MethodType(load, c)
 	c.enter_kdb = MethodType(enter_kdb, c)
 	c.expect_kdb = MethodType(expect_kdb, c)
 	c.sendline_kdb = MethodType(sendline_kdb, c)
 	c.inside_kdb = MethodType(inside_kdb, c)
 	c.exit_kdb = MethodType(exit_kdb, c)
 	c.run_command = MethodType(run_command_kdb, c)
+	c.measure_command = MethodType(measure_command_kdb, c)
 	c.get_regs = MethodType(get_regs_kdb, c)
 
 	if d:
@@ -346,9 +508,287 @@ def bind_methods(c, d):
 		d.expect_prompt = MethodType(gdb_expect_prompt, d)
 
 
+# When WARMGDB is set we keep gdb (and the symbols it has loaded) running
+# after a test closes its qemu instance. If the next test uses the same
+# vmlinux the parked gdb is reused and simply re-targeted.
+warm_gdb = None
+
+# Settings that tests change. A warm gdb starts with these and park_gdb()
+# puts them back so every test sees the same settings whether or not it
+# was given a parked gdb.
+WARM_GDB_SETTINGS = [
+	'set style enabled off',
+]
+
+def spawn_gdb(gdbcmd):
+	global warm_gdb
+
+	key = (gdbcmd, kbuild.get_mtime('vmlinux'))
+	if warm_gdb:
+		(gdb, warm_gdb) = (warm_gdb, None)
+		if gdb.warm_key == key and gdb.isalive():
+			print('+| (warm) ' + gdbcmd)
+			gdb.timeout = gdb.default_timeout
+			# Provoke a fresh prompt for connect_to_target()
+			gdb.sendline('echo')
+			return gdb
+		gdb.close()
+
+	if 'WARMGDB' in os.environ:
+		gdbcmd += ''.join([ f' -ex "{s}"' for s in WARM_GDB_SETTINGS ])
+
+	print('+| ' + gdbcmd)
+	gdb = pexpect.spawn(gdbcmd, encoding='utf-8', logfile=sys.stdout)
+	gdb.default_timeout = gdb.timeout
+	gdb.warm_key = key
+	return gdb
+
+def park_gdb(gdb):
+	'''Try to keep gdb running for reuse by a later test.
+
+	Must be called after qemu has been closed. Returns False if gdb
+	could not be parked (in which case the caller must close it).
+	'''
+	global warm_gdb
+
+	if 'WARMGDB' not in os.environ or not gdb.isalive():
+		return False
+
+	try:
+		gdb.timeout = 5
+		gdb.sendline('disconnect')
+		# Forget any breakpoints and displays the test left behind
+		gdb.sendline('set confirm off')
+		gdb.sendline('delete')
+		gdb.sendline('delete display')
+		gdb.sendline('set confirm on')
+		for setting in WARM_GDB_SETTINGS:
+			gdb.sendline(setting)
+		gdb.expect_prompt()
+	except (pexpect.TIMEOUT, pexpect.EOF):
+		return False
+
+	if warm_gdb:
+		warm_gdb.close()
+	warm_gdb = gdb
+	return True
+
+class Agent(object):
+	'''Client for the guest agent (see overlay/usr/sbin/kgdbtest-agent).
+
+	The agent runs commands in the guest on behalf of the host using a
+	dedicated virtio serial port. Unlike the console there is no echo
+	to parse and no need for sync tags, and the console is left free
+	for kdb.
+	'''
+	def __init__(self, path='agent.sock', timeout=30):
+		self.sock = socket.socket(socket.AF_UNIX)
+		# qemu may not have created the socket yet
+		for i in range(50):
+			try:
+				self.sock.connect(path)
+				break
+			except (FileNotFoundError, ConnectionRefusedError):
+				time.sleep(0.1)
+		else:
+			self.sock.connect(path)
+		self.sock.settimeout(timeout)
+		self.replies = self.sock.makefile('rb')
+		self.last_id = 0
+
+	def close(self):
+		self.replies.close()
+		self.sock.close()
+
+	def request(self, op, payload=''):
+		'''Send a request and return a (status, payload) tuple.'''
+		self.last_id += 1
+		data = payload.encode()
+		self.sock.sendall(f'{self.last_id} {op} {len(data)}\n'.encode() + data)
+
+		try:
+			(reply_id, status, length) = self.replies.readline().split()
+			data = self.replies.read(int(length))
+		except (socket.timeout, ValueError):
+			pytest.fail(f'No reply from guest agent ({op})')
+		assert int(reply_id) == self.last_id
+		return (int(status), data.decode(errors='replace'))
+
+	def wait(self, timeout=120):
+		'''Wait for the agent to start (it is one of the last things to).'''
+		old_timeout = self.sock.gettimeout()
+		self.sock.settimeout(timeout)
+		try:
+			(status, output) = self.request('ping')
+		finally:
+			self.sock.settimeout(old_timeout)
+		assert output == 'pong\n'
+
+	def run(self, cmd, check=True):
+		'''Run a shell command in the guest and return its output.'''
+		(status, output) = self.request('run', cmd)
+		if check and status != 0:
+			pytest.fail(f'{cmd} failed with status {status}: {output}')
+		return output
+
+	def start(self, name, cmd):
+		'''Run a shell command in the background (see stop()).'''
+		self.request('start', f'{name}\n{cmd}')
+
+	def stop(self, name):
+		(status, output) = self.request('stop', name)
+		if status != 0:
+			pytest.fail(f'Cannot stop {name}: {output}')
+
+	def sysrq(self, ch):
+		self.request('sysrq', ch)
+
+# Operations for each kind of background load (see Load). Each operation
+# is deliberately small so that the number completed is a useful measure
+# of the load.
+LOAD_OPS = {
+	# Spin without making any system calls
+	'cpu': 'i=0; while [ $i -lt 1000 ]; do i=$((i+1)); done',
+	# date is not a NOFORK applet so busybox must fork to run it
+	'fork': 'date > /dev/null',
+	# A redirection opens the file without forking
+	'open': ': < /proc/version',
+	'io': 'dd if=/dev/urandom of=/dev/null bs=65536 count=16 2> /dev/null',
+}
+
+# Names used by older tests (and SOAK_LOAD)
+LOAD_ALIASES = { 'dd': 'io', 'date': 'fork', 'find': 'open' }
+
+LOAD_DIR = '/tmp/kgdbtest-load'
+
+def parse_load(spec):
+	'''Parse a load from a kind[:workers][@rate] string.
+
+	For example, fork:2@100 runs two workers that try to fork a total
+	of 100 times a second. If the number of workers is omitted it is one
+	more than the number of guest CPUs and if the rate is omitted the
+	workers run flat out.
+	'''
+	m = re.fullmatch('([a-z]+)(?::([0-9]+))?(?:@([0-9]+))?', spec)
+	if not m or LOAD_ALIASES.get(m.group(1), m.group(1)) not in LOAD_OPS:
+		raise ValueError(f'Bad load: {spec}')
+	(kind, workers, rate) = m.groups()
+	return (LOAD_ALIASES.get(kind, kind),
+		int(workers) if workers else None,
+		int(rate) if rate else None)
+
+class Load(object):
+	'''Declarative background load for the guest.
+
+	The load is described by a list of (kind, workers, rate) tuples or
+	strings (see LOAD_OPS for the kinds and parse_load() for the string
+	format) and is used as a context manager:
+
+	    with console.load('io', 'fork@100') as load:
+	        ...
+	    print(load.rates)
+
+	On exit the load is stopped and the rate achieved by each kind of
+	load (in operations per second) is reported. The guest agent is
+	used to manage the load if one is attached, otherwise we type at
+	the shell (so the console must be at a shell prompt when the load
+	is started and stopped).
+	'''
+	def __init__(self, console, specs):
+		self.console = console
+		self.agent = getattr(console, 'agent', None)
+		self.specs = [ parse_load(s) if isinstance(s, str) else s for s in specs ]
+		self.workers = []
+		self.spec_workers = []
+		self.rates = {}
+
+	def shell(self, cmd, pattern):
+		'''Run cmd (using the agent or the shell) and match its output.'''
+		if self.agent:
+			output = self.agent.run(cmd)
+		else:
+			c = self.console
+			c.sendline(cmd)
+			c.expect_clean_output_until('# ')
+			output = c.before
+			c.expect_prompt(no_history=True)
+		return re.findall(pattern, output)
+
+	def script(self, kind, workers, rate, fname):
+		# Counting in a shell variable keeps the load free of any
+		# extra system calls. The count is saved when we are stopped.
+		delay = f'usleep {workers * 1000000 // rate}; ' if rate else ''
+		return (f"n=0; trap 'echo $n > {fname}; exit' TERM; " +
+			f'while true; do {LOAD_OPS[kind]}; n=$((n+1)); {delay}done')
+
+	def start(self):
+		(nproc,) = self.shell(f'rm -rf {LOAD_DIR}; mkdir -p {LOAD_DIR}; ' +
+				      'echo NPROC=$(nproc)', 'NPROC=([0-9]+)')
+
+		for (kind, workers, rate) in self.specs:
+			workers = workers if workers else int(nproc) + 1
+			names = []
+			for i in range(workers):
+				# Number workers across all specs since the same
+				# kind may appear more than once
+				name = f'{kind}.{len(self.workers)}'
+				script = self.script(kind, workers, rate, f'{LOAD_DIR}/{name}')
+				if self.agent:
+					self.agent.start(f'load-{name}', script)
+				else:
+					self.console.sendline(f'({script}) > /dev/null 2>&1 & ' +
+							      f'echo $! >> {LOAD_DIR}/pids')
+					self.console.expect_prompt()
+				self.workers.append(name)
+				names.append(name)
+			self.spec_workers.append(names)
+
+		if not self.agent:
+			(running,) = self.shell(f'echo RUNNING=$(wc -l < {LOAD_DIR}/pids)',
+						'RUNNING=([0-9]+)')
+			assert int(running) == len(self.workers)
+
+		self.start_time = time.monotonic()
+		return self
+
+	def stop(self):
+		elapsed = time.monotonic() - self.start_time
+		if self.agent:
+			for name in self.workers:
+				self.agent.stop(f'load-{name}')
+			self.agent.run('sleep 1')
+		else:
+			self.console.sendline(f'kill $(cat {LOAD_DIR}/pids); sleep 1')
+			self.console.expect_prompt()
+
+		counts = dict(self.shell(f'for f in {LOAD_DIR}/*.*; do echo "COUNT ${{f##*/}} $(cat $f)"; done',
+					 'COUNT ([a-z]+[.][0-9]+) ([0-9]+)'))
+		assert len(counts) == len(self.workers), 'Load did not stop cleanly'
+
+		self.rates = {}
+		for ((kind, workers, rate), names) in zip(self.specs, self.spec_workers):
+			achieved = sum([ int(counts[n]) for n in names ]) / elapsed
+			self.rates[kind] = self.rates.get(kind, 0) + achieved
+			target = f'{rate}/s' if rate else 'unlimited'
+			print(f'>>> {kind} load: target {target}, achieved {achieved:.1f}/s')
+		return self.rates
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		# If the test failed then the guest may not be able to stop
+		# the load and trying would only hide the original failure.
+		# It is cleaned up when qemu is closed.
+		if exc_type is None:
+			self.stop()
+
 class ConsoleWrapper(object):
-	def __init__(self, console, debug=None, monitor=None):
+	def __init__(self, console, debug=None, monitor=None, agent=None, rundir=None):
 		bind_methods(console, debug)
+		for channel in (console, debug, monitor):
+			if channel:
+				scan_for_failures(channel)
 
 		# Needed by expect_boot()/expect_prompt()
 		console.default_timeout = console.timeout
@@ -360,17 +800,28 @@ class ConsoleWrapper(object):
 		# connected.
 		console.gdb_on_second_uart = monitor == None
 
+		# When there is an agent the console uses it for sysrq
+		console.agent = agent
+
 		self.console = console
 		self.debug = debug
 		self.monitor = monitor
+		self.agent = agent
+		self.rundir = rundir
 
 
 	def close(self):
+		if self.agent:
+			self.agent.close()
 		if self.monitor:
 			self.monitor.close()
-		if self.debug:
-			self.debug.close()
 		self.console.close()
+		# gdb must be closed last so it can notice the target has
+		# gone away before we try to park it
+		if self.debug and not park_gdb(self.debug):
+			self.debug.close()
+		if self.rundir:
+			shutil.rmtree(self.rundir, ignore_errors=True)
 
 	def enter_gdb(self, sysrq=True):
 		(console, gdb) = (self.console, self.debug)
@@ -399,11 +850,110 @@ class ConsoleWrapper(object):
 			console.sendline('')
 			console.expect_prompt()
 
-def qemu(kdb=True, append=None, gdb=False, gfx=False, interactive=False, second_uart=False):
-	'''Create a qemu instance and provide pexpect channels to control it'''
-
-	arch = kbuild.get_arch()
-	host_arch = kbuild.get_host_arch()
+def hmp(command, sock):
+	'''Run a command using the qemu human monitor (see qemu(monitor=True)).'''
+	mon = pexpect.spawn(f'socat - UNIX-CONNECT:{sock}', encoding='utf-8')
+	try:
+		mon.expect('[(]qemu[)] ')
+		mon.sendline(command)
+		mon.expect('[(]qemu[)] ')
+		return mon.before
+	finally:
+		mon.close()
+
+def get_snapshot(cmd):
+	'''Name the snapshot for a qemu command line.
+
+	The name includes the modification time of every file mentioned on
+	the command line so rebuilding the kernel or rootfs will result in a
+	new snapshot. The run directory is left out of the name since every
+	guest has a different one.
+	'''
+	h = hashlib.sha256(cmd.encode())
+	for arg in cmd.split():
+		if os.path.isfile(arg):
+			h.update(f'{arg} {kbuild.get_mtime(arg)}'.encode())
+	return f'warm-standby/{h.hexdigest()[:16]}.state'
+
+def checkpoint(cmd, **kwargs):
+	'''Boot a guest to the shell prompt and snapshot it.
+
+	Returns the filename of the snapshot. If a matching snapshot already
+	exists then it is reused. Snapshots are taken whilst holding a lock
+	so, if several guests (or several test runs sharing the build
+	directory) want the same snapshot, only one of them boots a guest.
+	'''
+	snapshot = get_snapshot(cmd)
+	if os.path.exists(snapshot):
+		return snapshot
+
+	os.makedirs('warm-standby', exist_ok=True)
+	with open('warm-standby/lock', 'w') as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		if os.path.exists(snapshot):
+			return snapshot
+
+		print('>>> Booting warm standby guest')
+		kbuild.prune_cache('warm-standby/*.state', 3)
+
+		guest = qemu(monitor=True, **kwargs)
+		sock = guest.rundir + '/monitor.sock'
+		try:
+			guest.console.expect_boot()
+			guest.console.expect_busybox()
+			if guest.agent:
+				guest.agent.wait()
+
+			# The guest is left running whilst we migrate since the
+			# run state is restored along with everything else
+			hmp(f'migrate "exec:cat > {snapshot}.tmp"', sock)
+			for i in range(600):
+				status = hmp('info migrate', sock)
+				if 'completed' in status:
+					break
+				if 'failed' in status:
+					pytest.fail('Cannot snapshot warm standby guest')
+				time.sleep(0.1)
+			else:
+				pytest.fail('Timeout snapshotting warm standby guest')
+		finally:
+			guest.close()
+
+		os.rename(snapshot + '.tmp', snapshot)
+	return snapshot
+
+def qemu(kdb=True, append=None, gdb=False, gfx=False, interactive=False, second_uart=False,
+	 transport='uart', monitor=False, warm=False, agent=False):
+	'''Create a qemu instance and provide pexpect channels to control it
+
+	transport selects how the debug channel reaches the kernel. 'uart'
+	uses an emulated UART (either the console UART, demuxed by kdmx, or
+	a second UART if second_uart is set). 'virtio' routes kgdboc over a
+	virtio console (hvc0) which is much faster under TCG. The virtio
+	transport is only useful for gdb since kdb always talks on the
+	console.
+
+	Every guest gets its own run directory (under run/) for its sockets
+	so any number of guests can run from the same build directory.
+
+	monitor provides a qemu human monitor on monitor.sock, in the run
+	directory (see hmp()).
+
+	agent adds a virtio serial port for the guest agent and connects an
+	Agent to it. Once the agent is attached the console uses it for
+	sysrq() so tests must not expect sysrq to be echoed by the shell.
+
+	warm restores the guest from a snapshot taken at the shell prompt
+	(see checkpoint()) rather than booting from scratch. The snapshot
+	is taken the first time and reused until the kernel, rootfs or qemu
+	command line change. A restored guest prints nothing so tests must
+	use console.expect_prompt(no_history=True) instead of expect_boot().
+	Every restore starts from the same state so a warm guest can also
+	be used to isolate tests that damage the kernel.
+	'''
+
+	tree = kbuild.get_tree()
+	arch = tree.arch
 
 	if arch == 'arm' or arch == 'arm64':
 		tty = 'ttyAMA'
@@ -413,6 +963,25 @@ def qemu(kdb=True, append=None, gdb=False, gfx=False, interactive=False, second_
 	if arch == 'arm64' or arch == 'riscv':
 		second_uart = False
 
+	if warm and (gfx or (gdb and not second_uart and transport == 'uart')):
+		# We can only snapshot guests that we can boot unattended
+		print('>>> Cannot use a warm standby guest with this configuration')
+		warm = False
+	if warm:
+		monitor = True
+
+	# Relative paths keep the socket names short enough for AF_UNIX
+	os.makedirs('run', exist_ok=True)
+	rundir = os.path.relpath(tempfile.mkdtemp(prefix='qemu-', dir='run'))
+
+	if transport == 'virtio':
+		assert gdb
+		second_uart = False
+		gdb_sock = f'{rundir}/hvc0.sock'
+	else:
+		assert transport == 'uart'
+		gdb_sock = f'{rundir}/ttyS1.sock'
+
 	cmdline = ''
 	if gfx:
 		cmdline += ' console=tty0'
@@ -421,7 +990,9 @@ def qemu(kdb=True, append=None, gdb=False, gfx=False, interactive=False, second_
 		cmdline += ' kgdboc='
 		if gfx:
 			cmdline += 'kms,kbd,'
-		if not second_uart:
+		if transport == 'virtio':
+			cmdline += 'hvc0'
+		elif not second_uart:
 			cmdline += '{}0'.format(tty)
 		else:
 			cmdline += '{}1'.format(tty)
@@ -448,85 +1019,122 @@ def qemu(kdb=True, append=None, gdb=False, gfx=False, interactive=False, second_
 		cmd += ' -accel tcg,thread=multi '
 		cmd += ' -M vexpress-a15 -cpu cortex-a15'
 		cmd += ' -m 1G -smp 2'
-		cmd += ' -kernel arch/arm/boot/zImage'
-		if kbuild.get_version() < (6,5):
-			cmd += ' -dtb arch/arm/boot/dts/vexpress-v2p-ca15-tc1.dtb'
-		else:
-			cmd += ' -dtb arch/arm/boot/dts/arm/vexpress-v2p-ca15-tc1.dtb'
+		cmd += ' -kernel ' + kbuild.get_kernel_image()
+		cmd += ' -dtb ' + kbuild.get_dtb()
 	elif arch == 'arm64':
 		cmd = 'qemu-system-aarch64'
-		if host_arch == 'arm64' and os.path.exists('/dev/kvm'):
+		if tree.kvm:
 			cmd += ' -cpu host -M virt,gic_version=3,accel=kvm'
 		else:
 			cmd += ' -accel tcg,thread=multi '
 			cmd += ' -M virt,gic_version=3 -cpu cortex-a57'
 		cmd += ' -m 1G -smp 2'
-		cmd += ' -kernel arch/arm64/boot/Image'
+		cmd += ' -kernel ' + kbuild.get_kernel_image()
 	elif arch == 'mips':
 		cmd = 'qemu-system-mips64el'
 		cmd += ' -accel tcg,thread=multi '
 		cmd += ' -cpu I6400 -M malta'
 		cmd += ' -m 1G -smp 2'
-		cmd += ' -kernel vmlinux'
+		cmd += ' -kernel ' + kbuild.get_kernel_image()
 	elif arch == 'riscv':
 		cmd = 'qemu-system-riscv64'
 		cmd += ' -accel tcg,thread=multi'
 		cmd += ' -machine virt'
 		cmd += '  -m 1G -smp 2'
-		cmd += ' -kernel arch/riscv/boot/Image'
+		cmd += ' -kernel ' + kbuild.get_kernel_image()
 	elif arch == 'x86':
 		cmd = 'qemu-system-x86_64'
-		if host_arch == 'x86' and os.path.exists('/dev/kvm'):
+		if tree.kvm:
 			cmd += ' -enable-kvm'
 		cmd += ' -m 1G -smp 2'
-		cmd += ' -kernel arch/x86/boot/bzImage'
+		cmd += ' -kernel ' + kbuild.get_kernel_image()
 	else:
 		assert False
 
 	if not gfx:
 		cmd += ' -nographic'
-	if second_uart:
-		cmd += ' -monitor none'
+	if monitor:
+		monitor_opt = f' -monitor unix:{rundir}/monitor.sock,server,nowait'
+	else:
+		monitor_opt = ' -monitor none'
+	if transport == 'virtio' or agent:
+		# Machines with PCI get a PCI virtio-serial controller,
+		# the others rely on the virtio-mmio transports.
+		if arch in ('mips', 'x86'):
+			cmd += ' -device virtio-serial-pci'
+		else:
+			cmd += ' -device virtio-serial-device'
+	if agent:
+		cmd += f' -chardev socket,id=agent,path={rundir}/agent.sock,server,nowait'
+		cmd += ' -device virtserialport,chardev=agent,name=org.kgdbtest.agent'
+	if transport == 'virtio':
+		cmd += monitor_opt
+		cmd += ' -chardev stdio,id=mon,mux=on,signal=off -serial chardev:mon'
+		cmd += f' -chardev socket,id=hvc0,path={gdb_sock},server,nowait'
+		cmd += ' -device virtconsole,chardev=hvc0'
+	elif second_uart:
+		cmd += monitor_opt
 		cmd += ' -chardev stdio,id=mon,mux=on,signal=off -serial chardev:mon'
-		cmd += ' -chardev socket,id=ttyS1,path=ttyS1.sock,server,nowait'
+		cmd += f' -chardev socket,id=ttyS1,path={gdb_sock},server,nowait'
 		cmd += ' -serial chardev:ttyS1'
 	elif gdb:
 		cmd += ' -S -chardev pty,id=ttyS0 -serial chardev:ttyS0'
 	else:
-		cmd += ' -monitor none'
+		cmd += monitor_opt
 		cmd += ' -chardev stdio,id=mon,mux=on,signal=off -serial chardev:mon'
 
 	cmd += ' -initrd rootfs.cpio.gz'
 	cmd += ' -append "{}"'.format(cmdline)
 
+	# Pin qemu (and therefore all of its vCPU threads) to the CPUs that
+	# were reserved for the guests (see kbuild.get_cpu_budget()).
+	(build_cpus, vm_cpus) = kbuild.get_cpu_budget()
+	if vm_cpus:
+		cmd = 'taskset -c {} '.format(kbuild.format_cpu_list(vm_cpus)) + cmd
+
 	if gdb:
 		gdbcmd = kbuild.get_cross_compile('gdb')
+		gdbcmd += kbuild.get_gdb_index_options()
 		gdbcmd += ' vmlinux'
 		gdbcmd += ' -ex "set pagination 0"'
 
+	if warm:
+		snapshot = checkpoint(cmd.replace(rundir, 'RUNDIR'), kdb=kdb, append=append, gdb=gdb,
+				      second_uart=second_uart, transport=transport,
+				      agent=agent)
+		cmd += ' -incoming "exec:cat {}"'.format(snapshot)
+
 	if interactive:
 		if gdb:
 			gdbcmd += ' -ex "target extended-remote |' + \
-					'socat - UNIX:ttyS1.sock"'
+					'socat - UNIX:{}"'.format(gdb_sock)
 			print ('\n>>> (cd {}; {})\n'.format(
-					kbuild.get_kdir(), gdbcmd))
+					tree.kdir, gdbcmd))
+
+		if warm:
+			print('>>> Restoring warm standby guest (press Enter for a prompt)')
+		else:
+			time.sleep(5)
 
 		print('+| ' + cmd)
-		time.sleep(5)
 		os.system(cmd)
+		shutil.rmtree(rundir, ignore_errors=True)
 		return None
 
 	print('+| ' + cmd)
 	qemu = pexpect.spawn(cmd, encoding='utf-8', logfile=sys.stdout)
 
 	if gdb:
-		print('+| ' + gdbcmd)
-		gdb = pexpect.spawn(gdbcmd,
-				encoding='utf-8', logfile=sys.stdout)
+		gdb = spawn_gdb(gdbcmd)
 	else:
 		gdb = None
 
-	if gdb and not second_uart:
+	if agent:
+		agent = Agent(f'{rundir}/agent.sock')
+	else:
+		agent = None
+
+	if gdb and not second_uart and transport == 'uart':
 		monitor = qemu
 		monitor.expect('char device redirected to (/dev/pts/[0-9]*) .label')
 		uart_pty = monitor.match.group(1)
@@ -561,8 +1169,8 @@ def qemu(kdb=True, append=None, gdb=False, gfx=False, interactive=False, second_
 		monitor.sendline('cont')
 		monitor.expect('[(]qemu[)]')
 
-		return ConsoleWrapper(console, gdb, monitor)
+		return ConsoleWrapper(console, gdb, monitor, agent, rundir)
 	else:
 		if gdb:
-			gdb.connection = '|socat - UNIX:ttyS1.sock'
-		return ConsoleWrapper(qemu, gdb)
+			gdb.connection = f'|socat - UNIX:{gdb_sock}'
+		return ConsoleWrapper(qemu, gdb, agent=agent, rundir=rundir)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+def main(argv):
+	'''Merge the junit results from make matrix into a single report.
+
+	Usage: matrix_report.py OUTPUT INPUT...
+
+	Each input is expected to be named <phase>-<arch>.xml. The suites
+	and test cases are renamed so the phase and architecture can be
+	identified in the merged report.
+	'''
+	output = argv[1]
+	merged = ET.Element('testsuites')
+	summary = []
+
+	for fname in sorted(argv[2:]):
+		if not os.path.exists(fname):
+			# Unexpanded glob (no results at all)
+			continue
+		(phase, arch) = os.path.basename(fname)[:-4].split('-', 1)
+
+		root = ET.parse(fname).getroot()
+		suites = [ root ] if root.tag == 'testsuite' else list(root)
+		for suite in suites:
+			suite.set('name', f'{arch}.{phase}')
+			for case in suite.iter('testcase'):
+				case.set('classname', f"{arch}.{case.get('classname')}")
+			merged.append(suite)
+
+			summary.append((arch, phase) + tuple(
+				int(suite.get(k, 0)) for k in
+				('tests', 'failures', 'errors', 'skipped')))
+
+	ET.ElementTree(merged).write(output, encoding='utf-8', xml_declaration=True)
+
+	print(f"{'arch':8} {'phase':8} {'tests':>6} {'fail':>6} {'error':>6} {'skip':>6}")
+	for row in sorted(summary):
+		print('{:8} {:8} {:6} {:6} {:6} {:6}'.format(*row))
+	print(f'Merged results written to {output}')
+
+	failed = [ row for row in summary if row[3] or row[4] ]
+	return 1 if failed or not summary else 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
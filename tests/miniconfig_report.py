@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import kbuild
+import ktest
+import os
+import statistics
+import sys
+import time
+
+PROFILES = ('default', 'minimal')
+
+def set_profile(profile):
+	if profile == 'minimal':
+		os.environ['MINICONFIG'] = '1'
+	else:
+		os.environ.pop('MINICONFIG', None)
+
+def measure_build():
+	'''Build the kernel from clean and report how long it took.'''
+	kbuild.config(kgdb=True)
+	kbuild.run('make -s clean', 'Cannot clean kernel')
+	start = time.monotonic()
+	kbuild.build()
+	return time.monotonic() - start
+
+def measure_boot():
+	'''Boot the kernel and time how long it takes to reach a shell.'''
+	start = time.monotonic()
+	qemu = ktest.qemu()
+	try:
+		c = qemu.console
+		c.expect_boot()
+		c.expect_busybox()
+		return time.monotonic() - start
+	finally:
+		qemu.close()
+
+def count_modules():
+	n = 0
+	for (dirpath, dirnames, filenames) in os.walk('mod-rootfs'):
+		n += len([ f for f in filenames if f.endswith('.ko') ])
+	return n
+
+def main(argv):
+	'''Compare the build and boot time of the default and minimal configs.
+
+	Usage: miniconfig_report.py [RUNS]
+
+	Both profiles are built from clean (so this takes a while) and then
+	booted RUNS times. The kernel is left configured using whichever
+	profile the environment asks for.
+	'''
+	runs = int(argv[1]) if len(argv) > 1 else 3
+	wanted = 'MINICONFIG' in os.environ
+
+	results = {}
+	for profile in PROFILES:
+		set_profile(profile)
+		build = measure_build()
+		boot = statistics.median([ measure_boot() for i in range(runs) ])
+		results[profile] = (build, boot,
+				    os.stat('vmlinux').st_size,
+				    os.stat('rootfs.cpio.gz').st_size,
+				    count_modules())
+
+	print(f"\n>>> {'profile':8} {'build':>8} {'boot':>8} {'vmlinux':>10} {'rootfs':>10} {'modules':>8}")
+	for (profile, (build, boot, vmlinux, rootfs, modules)) in results.items():
+		print(f'>>> {profile:8} {build:7.1f}s {boot:7.1f}s {vmlinux // 1024:9}K {rootfs // 1024:9}K {modules:8}')
+
+	(build, boot) = [ results['default'][i] - results['minimal'][i] for i in (0, 1) ]
+	print(f'>>> minimal saves {build:.1f}s building and {boot:.1f}s booting on {kbuild.get_arch()}')
+
+	# Put things back the way we found them. If the environment wants
+	# the default profile this is another full build (the tree was
+	# just cleaned and built with the minimal profile) but it is not
+	# part of the comparison so it is not timed.
+	set_profile('minimal' if wanted else 'default')
+	kbuild.config(kgdb=True)
+	kbuild.build()
+	return 0
+
+if __name__ == '__main__':
+	try:
+		sys.exit(main(sys.argv))
+	except KeyboardInterrupt:
+		sys.exit(1)
+	sys.exit(127)
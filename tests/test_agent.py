@@ -0,0 +1,50 @@
+import kbuild
+import ktest
+import pytest
+
+@pytest.fixture(scope="module")
+def kdb():
+	kbuild.config(kgdb=True)
+	kbuild.build()
+
+	qemu = ktest.qemu(agent=True)
+
+	console = qemu.console
+	console.expect_boot()
+	console.expect_busybox()
+	qemu.agent.wait()
+
+	yield qemu
+
+	qemu.close()
+
+def test_agent_run(kdb):
+	'''Run commands in the guest without using the console.'''
+	agent = kdb.agent
+	assert agent.run('echo hello') == 'hello\n'
+	assert agent.run('exit 3', check=False) == ''
+
+	(status, output) = agent.request('run', 'exit 3')
+	assert status == 3
+
+def test_agent_background(kdb):
+	'''Start and stop a background job.'''
+	agent = kdb.agent
+	agent.start('counter', 'while true; do echo x >> /tmp/counter; sleep 0.1; done')
+	agent.run('sleep 1')
+	agent.stop('counter')
+	count = int(agent.run('wc -l < /tmp/counter'))
+	assert count > 0
+
+	# Make sure it has really stopped
+	agent.run('sleep 1')
+	assert int(agent.run('wc -l < /tmp/counter')) == count
+	agent.run('rm /tmp/counter')
+
+def test_agent_sysrq(kdb):
+	'''Enter kdb using the agent rather than the console.'''
+	c = kdb.console.enter_kdb()
+	c.exit_kdb()
+
+	# The agent must still be working after we resume
+	assert kdb.agent.run('echo resumed') == 'resumed\n'
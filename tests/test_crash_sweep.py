@@ -0,0 +1,213 @@
+import asyncio
+import json
+import kasync
+import kbuild
+import ktest
+import os
+import pexpect
+import pytest
+import re
+
+# The sweep launches a guest for every crash type so it only runs when
+# CRASH_SWEEP is set. If CRASH_SWEEP is a number then it sets the number
+# of kdb guests that run in parallel. CRASH_SWEEP_TYPES can be used to
+# restrict the sweep to a comma separated list of crash types.
+pytestmark = pytest.mark.skipif('CRASH_SWEEP' not in os.environ,
+		reason = 'Set CRASH_SWEEP to run the LKDTM crash sweep')
+
+def get_parallel():
+	try:
+		return max(1, int(os.environ['CRASH_SWEEP']))
+	except ValueError:
+		return 4
+
+# LKDTM crash types (see drivers/misc/lkdtm/). Types that the kernel under
+# test does not provide are reported as unavailable.
+CRASH_TYPES = (
+	'PANIC', 'BUG', 'WARNING', 'WARNING_MESSAGE', 'EXCEPTION',
+	'EXHAUST_STACK', 'CORRUPT_STACK', 'CORRUPT_STACK_STRONG',
+	'STACK_GUARD_PAGE_LEADING', 'STACK_GUARD_PAGE_TRAILING',
+	'UNALIGNED_LOAD_STORE_WRITE', 'DOUBLE_FAULT', 'UNSET_SMEP',
+	'ARRAY_BOUNDS', 'CORRUPT_LIST_ADD', 'CORRUPT_LIST_DEL',
+	'ACCESS_NULL', 'ACCESS_USERSPACE', 'WRITE_RO', 'WRITE_RO_AFTER_INIT',
+	'WRITE_KERN', 'EXEC_DATA', 'EXEC_STACK', 'EXEC_KMALLOC',
+	'EXEC_VMALLOC', 'EXEC_RODATA', 'EXEC_USERSPACE', 'EXEC_NULL',
+	'READ_AFTER_FREE', 'WRITE_AFTER_FREE', 'SLAB_FREE_DOUBLE',
+	'SOFTLOCKUP', 'HARDLOCKUP', 'SPINLOCKUP',
+)
+
+def get_crash_types():
+	if 'CRASH_SWEEP_TYPES' in os.environ:
+		return os.environ['CRASH_SWEEP_TYPES'].split(',')
+	return CRASH_TYPES
+
+# How long to wait for the debugger. The lockup detectors need longer.
+ENTRY_TIMEOUT = 30
+SLOW_ENTRY_TIMEOUT = 60
+SLOW_CRASH_TYPES = ('SOFTLOCKUP', 'HARDLOCKUP', 'SPINLOCKUP')
+
+# If the debugger cannot catch these then something is badly wrong
+MUST_ENTER = ('BUG', 'EXCEPTION', 'PANIC')
+
+# Every case starts from a snapshot of the booted guest (see
+# ktest.checkpoint()) so it does not matter how badly we damage it. Each
+# guest has its own run directory (and therefore its own monitor and gdb
+# sockets) so the guests cannot interfere with each other. kgdb uses the
+# virtio transport because warm guests cannot demux the console. The
+# kgdb guests still run one at a time because they share the (parked)
+# gdb when WARMGDB is set.
+GUESTS = {
+	'kdb': dict(warm=True),
+	'kgdb': dict(warm=True, gdb=True, transport='virtio'),
+}
+
+PROVOKE = '/bin/echo {} > /sys/kernel/debug/provoke-crash/DIRECT'
+
+def get_available(mode):
+	'''Ask LKDTM which crash types it supports.
+
+	This also takes the snapshot before we fan out so the parallel
+	guests do not all queue up behind checkpoint().
+	'''
+	qemu = ktest.qemu(**GUESTS[mode])
+	try:
+		c = qemu.console
+		c.expect_prompt(no_history=True)
+		c.sendline('cat /sys/kernel/debug/provoke-crash/DIRECT')
+		c.expect('Available crash types:')
+		c.expect('# ')
+		return c.before.split()
+	finally:
+		qemu.close()
+
+def get_reason(text):
+	'''Extract the reason from kdb's "Entering kdb" message.'''
+	m = re.search('due to ([^@\r\n]*)', text)
+	reason = m.group(1).strip() if m else 'unknown'
+	m = re.search('Oops: ([^\r\n]*)', text)
+	if m:
+		reason += f' ({m.group(1).strip()})'
+	return reason
+
+async def race(timeout, **expectations):
+	'''Wait for whichever expectation is met first.
+
+	Returns the name of the expectation or None if none of them were met
+	before the timeout.
+	'''
+	tasks = { asyncio.ensure_future(e): name for (name, e) in expectations.items() }
+	(done, pending) = await asyncio.wait(tasks, timeout=timeout,
+					     return_when=asyncio.FIRST_COMPLETED)
+	for t in pending:
+		t.cancel()
+	for t in done:
+		if not t.exception():
+			return tasks[t]
+	return None
+
+async def provoke(mode, crash):
+	'''Provoke a crash and record how the debugger reacts.'''
+	timeout = SLOW_ENTRY_TIMEOUT if crash in SLOW_CRASH_TYPES else ENTRY_TIMEOUT
+	loop = asyncio.get_running_loop()
+	qemu = await kasync.qemu(**GUESTS[mode])
+	try:
+		# We expect (and want to record) all manner of failures
+		qemu.qemu.console.scan_enabled = False
+		if qemu.qemu.debug:
+			qemu.qemu.debug.scan_enabled = False
+
+		(c, gdb) = (qemu.console, qemu.debug)
+		await c.expect_prompt(no_history=True)
+		if mode == 'kgdb':
+			c.sysrq('g')
+			await gdb.connect_to_target()
+			await qemu.exit_gdb(shell=True)
+
+		start = loop.time()
+		c.sendline(PROVOKE.format(crash))
+		if mode == 'kdb':
+			try:
+				choice = await c.expect(['Entering kdb', '# '], timeout=timeout)
+			except (pexpect.TIMEOUT, pexpect.EOF):
+				choice = None
+			outcome = { 0: 'entered', 1: 'returned', None: 'timeout' }[choice]
+		else:
+			outcome = await race(timeout,
+				entered=gdb.expect('received signal ([A-Z0-9]+)', timeout=timeout+1),
+				returned=c.expect('# ', timeout=timeout+1))
+			outcome = outcome if outcome else 'timeout'
+		result = { 'outcome': outcome }
+		if outcome != 'entered':
+			return result
+
+		result['latency'] = round(loop.time() - start, 3)
+		if mode == 'kdb':
+			await c.expect(['kdb>', 'more>'])
+			result['reason'] = get_reason(c.before)
+		else:
+			result['reason'] = gdb.match.group(1)
+		return result
+	finally:
+		qemu.close()
+
+async def sweep(mode, crashes):
+	parallel = get_parallel() if mode == 'kdb' else 1
+	slots = asyncio.Semaphore(parallel)
+
+	async def run(crash):
+		async with slots:
+			return await provoke(mode, crash)
+
+	results = await asyncio.gather(*[ run(crash) for crash in crashes ])
+	return dict(zip(crashes, results))
+
+def report(mode, results):
+	print(f"\n>>> {'crash type':28} {mode + ' outcome':14} {'latency':>8}  reason")
+	for (crash, r) in results.items():
+		latency = f"{r['latency']:.2f}s" if 'latency' in r else ''
+		print(f">>> {crash:28} {r['outcome']:14} {latency:>8}  {r.get('reason', '')}")
+
+def save(mode, results):
+	'''Save the results for tests/crash_matrix.py (crash-sweep.json).'''
+	try:
+		with open('crash-sweep.json') as f:
+			data = json.load(f)
+	except (FileNotFoundError, ValueError):
+		data = {}
+	data['arch'] = kbuild.get_arch()
+	data['version'] = '.'.join([ str(v) for v in kbuild.get_version() ])
+	data.setdefault('results', {})[mode] = results
+	with open('crash-sweep.json', 'w') as f:
+		json.dump(data, f, indent=1)
+
+@pytest.fixture(scope="module")
+def build():
+	kbuild.config(kgdb=True)
+	kbuild.build()
+
+@pytest.mark.parametrize('mode', ('kdb', 'kgdb'))
+def test_crash_sweep(build, mode, record_property):
+	'''Provoke every LKDTM crash type and record how the debugger reacts.
+
+	This is mostly a survey rather than a pass/fail test. The results
+	are printed, recorded as junit properties and saved (with the
+	results for other architectures, see tests/crash_matrix.py). The test
+	only fails if the debugger cannot catch the most basic crashes.
+	'''
+	available = get_available(mode)
+	crashes = [ c for c in get_crash_types() if c in available ]
+
+	results = asyncio.run(sweep(mode, crashes))
+	for crash in get_crash_types():
+		if crash not in available:
+			results[crash] = { 'outcome': 'unavailable' }
+
+	report(mode, results)
+	save(mode, results)
+	for (crash, r) in results.items():
+		record_property(crash, r['outcome'])
+
+	missed = [ c for c in MUST_ENTER
+			if results.get(c, {}).get('outcome') not in (None, 'entered', 'unavailable') ]
+	if missed:
+		pytest.fail(f'{mode} did not catch {", ".join(missed)}')
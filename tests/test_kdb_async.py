@@ -0,0 +1,41 @@
+import asyncio
+import kasync
+import kbuild
+import pytest
+
+NUM_GUESTS = 4
+
+@pytest.fixture(scope="module")
+def build():
+	kbuild.config(kgdb=True)
+	kbuild.build()
+
+def test_concurrent_guests(build):
+	'''Drive kdb on several guests at once from a single thread.'''
+
+	async def exercise(qemu):
+		c = qemu.console
+		await c.expect_boot()
+		await c.expect_busybox()
+
+		summary = await c.run_command('summary')
+		assert summary.startswith('sysname    Linux')
+
+		await c.enter_kdb()
+		try:
+			output = await c.run_command('btp 1')
+			assert output.startswith('Stack traceback for pid 1')
+		finally:
+			await c.exit_kdb()
+
+	async def main():
+		guests = []
+		try:
+			for i in range(NUM_GUESTS):
+				guests.append(await kasync.qemu())
+			await asyncio.gather(*[ exercise(g) for g in guests ])
+		finally:
+			for g in guests:
+				g.close()
+
+	asyncio.run(main())
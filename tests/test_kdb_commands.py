@@ -119,38 +119,28 @@ def test_btc(kdb):
         This is a simple survival test.
 	'''
 	c = kdb.console
-	try:
-		# Generate some load
-		c.sendline('n=$((`nproc` + 1))')
-		c.expect_prompt()
-		c.sendline('for i in `seq $n`; do dd if=/dev/urandom of=/dev/null bs=65536 & done')
-		c.expect_prompt()
-
-		c.enter_kdb()
+	with c.load('io'):
+		try:
+			c.enter_kdb()
 
-		# btc/start/stop
-		for i in range(16):
+			# btc/start/stop
+			for i in range(16):
 
-			c.sendline('btc | grep traceback')
+				c.sendline('btc | grep traceback')
 
-			choices = ['kdb>', 'traceback']
-			choice = c.expect(choices)
-			while 1 == choice:
+				choices = ['kdb>', 'traceback']
 				choice = c.expect(choices)
-			assert choice == 0
-
-			# Let userspace run for a moment
-			c.exit_kdb()
-			c.enter_kdb()
+				while 1 == choice:
+					choice = c.expect(choices)
+				assert choice == 0
 
+				# Let userspace run for a moment
+				c.exit_kdb()
+				c.enter_kdb()
 
-	finally:
-		c.exit_kdb()
-
-		# Terminate the load generating tasks
-		c.expect_prompt(no_history=True)
-		c.sendline('for i in `seq $n`; do kill %$i; done; sleep 1')
-		c.expect_prompt()
+		finally:
+			c.exit_kdb()
+			c.expect_prompt(no_history=True)
 
 def test_btp(kdb):
 	'''Test `btp` (backtrace specific PID)'''
@@ -272,6 +262,44 @@ def test_mdXc1(kdb):
 	finally:
 		kdb.console.exit_kdb()
 
+def md_address(c, sym):
+	'''Get the address of a symbol by asking md to display it.'''
+	output = c.run_command(f'md1c1 {sym}')
+	return int(re.search('0x([0-9a-f]+) ', output).group(1), 16)
+
+def get_symbols(c):
+	'''Get the host side symbol index, relocated to match the guest.
+
+	KASLR means the kernel may not be where System.map says. We use the
+	address md reports for kdb_printf to relocate the index.
+	'''
+	syms = kbuild.get_symbols()
+	syms.relocate('kdb_printf', md_address(c, 'kdb_printf'))
+	return syms
+
+def test_md_address(kdb):
+	'''Check md and bp agree with the host side symbol index.'''
+	c = kdb.console.enter_kdb()
+	try:
+		syms = get_symbols(c)
+
+		# Once relocated the index must agree with kdb about
+		# every other symbol
+		addr = md_address(c, 'kdb_parse')
+		assert addr == syms.address('kdb_parse')
+		assert syms.lookup(addr) == ('kdb_parse', 0)
+
+		# Instruction(i) BP #0 at 0x1071b728 (write_sysrq_trigger)
+		output = c.run_command('bp write_sysrq_trigger')
+		m = re.search('BP #([0-9]+) at 0x([0-9a-f]+)', output)
+		assert int(m.group(2), 16) == syms.address('write_sysrq_trigger')
+
+		c.sendline(f'bc {m.group(1)}')
+		c.expect('Breakpoint.*cleared')
+		c.expect_prompt()
+	finally:
+		c.exit_kdb()
+
 def test_mdXc4(kdb):
 	kdb.console.enter_kdb()
 	try:
@@ -468,12 +496,15 @@ def test_ss(kdb):
 	'''
 	Test the `ss` command.
 
-	Currently this is merely a survival test; we do not check that
-	the PC advances during the step. There's currently too much
-	variability between the architectures to go deeper on this.
+	We check that each step changes the PC and that the first step
+	stays inside the function with the breakpoint. There's currently
+	too much variability between the architectures to go deeper on
+	this.
 	'''
 	c = kdb.console.enter_kdb()
 	try:
+		syms = get_symbols(c)
+
 		# Set breakpoint to some place we can step fairly far
 		c.sendline('bp write_sysrq_trigger')
 		c.expect_prompt()
@@ -491,12 +522,20 @@ def test_ss(kdb):
 			c.expect('Entering kdb')
 			choice = c.expect(['due to SS', 'due to Breakpoint'])
 			assert(choice == 0)
-			c.expect(' @ 0x[0-9a-f]*[^0-9a-f]')
+			c.expect(' @ 0x([0-9a-f]*)[^0-9a-f]')
 			newpc = c.after
+			pc = int(c.match.group(1), 16)
 			c.expect_prompt()
 
 			assert(newpc != oldpc)
 			oldpc = newpc
+
+			# Every step must land in the kernel text, and the
+			# first one cannot have left the function yet
+			sym = syms.lookup(pc)
+			assert sym
+			if i == 0:
+				assert sym[0] == 'write_sysrq_trigger'
 	finally:
 		# Clear the breakpoint (doesn't matter if we never set it...
 		# we'll still get a prompt and be recovered for the next test.
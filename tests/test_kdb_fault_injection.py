@@ -3,40 +3,32 @@ import ktest
 import pytest
 
 @pytest.fixture(scope="module")
-def kdb():
+def build():
 	kbuild.config(kgdb=True)
 	kbuild.build()
 
-	qemu = ktest.qemu()
+@pytest.fixture()
+def kdb(build):
+	'''
+	Restore a freshly booted guest for every test.
 
-	console = qemu.console
-	console.expect_boot()
-	console.expect_busybox()
+	These tests deliberately damage the kernel so each one starts from a
+	checkpoint of the booted guest (see ktest.checkpoint()) and the guest
+	is thrown away afterwards. This is much quicker than a cold boot.
+	'''
+	qemu = ktest.qemu(warm=True)
+	qemu.console.expect_prompt(no_history=True)
 
 	yield qemu
 
 	qemu.close()
 
-@pytest.mark.xfail(condition = (kbuild.get_arch() == 'mips'),
-                   reason = "Triggers breakpoint twice", run = False)
-# RISC-V bug reported here: https://lore.kernel.org/all/ZJ2PBosSQtSX28Mf@wychelm/
-@pytest.mark.xfail(condition = (kbuild.get_arch() == 'riscv' and kbuild.get_version() >= (6, 4)),
-                   reason = "Panics on resume")
-@pytest.mark.xfail(condition = (kbuild.get_arch() == 'x86'),
-                   reason = "Triggers breakpoint twice", run = False)
-def test_BUG(kdb):
-	'''
-	Test how kdb reacts to a BUG()
-	'''
-
+def provoke_BUG(kdb):
 	# Must use /bin/echo... if we use a shell built-in then the
 	# kernel will kill off the shell when we resume
 	kdb.console.sendline('/bin/echo BUG > /sys/kernel/debug/provoke-crash/DIRECT')
 
 	kdb.console.expect('Entering kdb')
-	# If we timeout here its probably because we've returned to the
-	# shell prompt... thankfully that means we don't need any custom
-	# error recovery to set us up for the next test!
 	kdb.console.expect_kdb()
 
 	kdb.console.send('go\r')
@@ -47,6 +39,19 @@ def test_BUG(kdb):
 	kdb.console.send('go\r')
 	kdb.console.expect_prompt()
 
+@pytest.mark.xfail(condition = (kbuild.get_arch() == 'mips'),
+                   reason = "Triggers breakpoint twice", run = False)
+# RISC-V bug reported here: https://lore.kernel.org/all/ZJ2PBosSQtSX28Mf@wychelm/
+@pytest.mark.xfail(condition = (kbuild.get_arch() == 'riscv' and kbuild.get_version() >= (6, 4)),
+                   reason = "Panics on resume")
+@pytest.mark.xfail(condition = (kbuild.get_arch() == 'x86'),
+                   reason = "Triggers breakpoint twice", run = False)
+def test_BUG(kdb):
+	'''
+	Test how kdb reacts to a BUG()
+	'''
+	provoke_BUG(kdb)
+
 @pytest.mark.xfail(condition = (kbuild.get_arch() == 'mips'),
                    reason = "Triggers breakpoint twice", run = False)
 # RISC-V bug reported here: https://lore.kernel.org/all/ZJ2PBosSQtSX28Mf@wychelm/
@@ -60,13 +65,12 @@ def test_BUG_again(kdb):
 
 	This test effectively ensures there is nothing "sticky" about
 	continuing past the catastrophic error (i.e. this is an important
-	property for test suite robustness.
+	property for test suite robustness). Each test starts from a fresh
+	guest so we must provoke both BUG()s here.
 	'''
-	test_BUG(kdb)
+	provoke_BUG(kdb)
+	provoke_BUG(kdb)
 
-# RISC-V bug reported here: https://lore.kernel.org/all/ZJ2PBosSQtSX28Mf@wychelm/
-@pytest.mark.xfail(condition = (kbuild.get_arch() == 'riscv' and kbuild.get_version() >= (6, 4)),
-                   reason = "Previous BUG() invocation kills this test")
 def test_WARNING(kdb):
 	'''
 	Test that kdb does *not* enter during a WARN_ON()
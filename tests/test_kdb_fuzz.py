@@ -0,0 +1,224 @@
+import kbuild
+import kdbedit
+import ktest
+import os
+import pexpect
+import pytest
+import random
+import re
+import time
+
+# The fuzzer only runs when FUZZ is set. If FUZZ is a number then it sets
+# the number of test cases to run. Each run prints its seed and a run can
+# be replayed exactly by setting FUZZ_SEED.
+pytestmark = pytest.mark.skipif('FUZZ' not in os.environ,
+		reason = 'Set FUZZ to run the kdb input fuzzer')
+
+def get_cases():
+	try:
+		return max(1, int(os.environ['FUZZ']))
+	except ValueError:
+		return 200
+
+def get_seed():
+	if 'FUZZ_SEED' in os.environ:
+		return int(os.environ['FUZZ_SEED'])
+	return random.randrange(1 << 32)
+
+# Letters that do not begin any kdb command (so every line we type is
+# reported back as an unknown command)
+ALPHABET = 'wxyz'
+
+MAX_OPS = 40
+PAGER_RATE = 0.05
+
+UNKNOWN = re.compile("Unknown[ a-z]*: '([^'\r\n]*)'")
+
+def minimise(ops, fails):
+	'''Reduce a failing list of ops using delta debugging (ddmin).'''
+	n = 2
+	while len(ops) >= 2:
+		chunk = -(-len(ops) // n)
+		subsets = [ ops[i:i+chunk] for i in range(0, len(ops), chunk) ]
+		for (i, subset) in enumerate(subsets):
+			complement = sum(subsets[:i] + subsets[i+1:], [])
+			if fails(subset):
+				(ops, n) = (subset, 2)
+				break
+			if fails(complement):
+				(ops, n) = (complement, max(n - 1, 2))
+				break
+		else:
+			if n >= len(ops):
+				break
+			n = min(len(ops), n * 2)
+	return ops
+
+class Watchdog(object):
+	'''Adaptive timeout based on how quickly kdb has been responding.
+
+	A fixed timeout is either too short for a slow (TCG) guest or so
+	long that a hang wastes minutes. Instead we track a moving average
+	of the time taken per keystroke and allow a generous multiple of it.
+	'''
+	def __init__(self, floor=2, margin=10):
+		self.floor = floor
+		self.margin = margin
+		self.per_key = None
+
+	def timeout(self, nkeys):
+		if self.per_key is None:
+			return 30
+		return self.floor + self.margin * self.per_key * nkeys
+
+	def update(self, nkeys, seconds):
+		sample = seconds / nkeys
+		if self.per_key is None:
+			self.per_key = sample
+		else:
+			self.per_key = 0.8 * self.per_key + 0.2 * sample
+
+class Fuzzer(object):
+	def __init__(self, console):
+		self.console = console
+		self.model = kdbedit.LineEditor(kbuild.get_symbols())
+		self.watchdog = Watchdog()
+
+	def sync(self, keys):
+		'''Send keys and wait until kdb has finished processing them.
+
+		Returns everything kdb printed in response.
+		'''
+		c = self.console
+		tag = ktest.unique_tag('FUZZSYNC')
+		nkeys = len(keys) + len(tag) + 1
+
+		start = time.monotonic()
+		c.send(keys)
+		c.send(tag + '\r')
+		c.expect('Unknown[^\r\n]*' + tag, timeout=self.watchdog.timeout(nkeys))
+		output = c.before
+		c.expect('kdb>', timeout=self.watchdog.timeout(1))
+		self.watchdog.update(nkeys, time.monotonic() - start)
+
+		self.model.feed(tag + '\r')
+		return output
+
+	def prime(self):
+		'''Fill the command history with known values.'''
+		c = self.console
+		lines = [ f'{ALPHABET[i % len(ALPHABET)]}prime{i:02}'
+				for i in range(kdbedit.HISTORY_COUNT - 1) ]
+		for ln in lines:
+			start = time.monotonic()
+			c.send(ln + '\r')
+			c.expect('Unknown[^\r\n]*' + ln, timeout=self.watchdog.timeout(len(ln)))
+			c.expect('kdb>', timeout=self.watchdog.timeout(1))
+			self.watchdog.update(len(ln) + 1, time.monotonic() - start)
+		self.model.prime(lines)
+
+	def run(self, ops):
+		'''Run a single command line.
+
+		Returns the (expected, actual) command or (None, actual) if the
+		result could not be predicted by the model.
+		'''
+		if not self.model.primed:
+			self.prime()
+
+		keys = ''.join(ops) + '\r'
+		try:
+			executed = self.model.feed(keys)
+			expected = executed[0] if len(executed) == 1 else None
+		except kdbedit.Unpredictable:
+			expected = None
+			self.model.forget()
+
+		matches = UNKNOWN.findall(self.sync(keys))
+		actual = matches[-1] if matches else None
+
+		if expected is not None and not self.model.unknown(expected):
+			expected = None
+		return (expected, actual)
+
+	def fails(self, ops):
+		(expected, actual) = self.run(ops)
+		return expected is not None and expected != actual
+
+	def pager(self, rng):
+		'''Run a command that triggers the pager and then type at it.'''
+		c = self.console
+		c.send('help\r')
+		for i in range(rng.randint(1, 8)):
+			if 1 == c.expect(['more> ', 'kdb> '], timeout=self.watchdog.timeout(1)):
+				break
+			c.send(rng.choice(' \r'))
+		else:
+			if 0 == c.expect(['more> ', 'kdb> '], timeout=self.watchdog.timeout(1)):
+				c.send('q')
+				c.expect('kdb> ', timeout=self.watchdog.timeout(1))
+
+		# If the history were to recall help then the pager could eat
+		# our sync tags. Priming the history will flush it out again.
+		self.model.forget()
+		self.sync('')
+
+@pytest.fixture(scope="module")
+def kdb():
+	kbuild.config(kgdb=True)
+	kbuild.build()
+
+	qemu = ktest.qemu()
+
+	console = qemu.console
+	console.expect_boot()
+	console.expect_busybox()
+
+	yield qemu
+
+	qemu.close()
+
+def test_kdb_fuzz(kdb, record_property):
+	'''Type random command lines and check kdb's editor against a model.'''
+	seed = get_seed()
+	print(f'>>> FUZZ_SEED={seed}')
+	record_property('seed', seed)
+	rng = random.Random(seed)
+
+	(checked, unchecked) = (0, 0)
+	ops = []
+
+	c = kdb.console.enter_kdb()
+	fuzzer = Fuzzer(c)
+	hung = False
+	try:
+		for i in range(get_cases()):
+			if rng.random() < PAGER_RATE:
+				ops = [ 'help' ]
+				fuzzer.pager(rng)
+				continue
+
+			ops = kdbedit.random_keystrokes(rng, rng.randint(1, MAX_OPS), ALPHABET)
+			(expected, actual) = fuzzer.run(ops)
+			if expected is None:
+				unchecked += 1
+				continue
+			checked += 1
+
+			if expected != actual:
+				small = minimise(ops, fuzzer.fails)
+				pytest.fail(f'kdb ran {actual!r} but model expected {expected!r}\n' +
+					    f'Minimised keystrokes: {small!r}\n' +
+					    f'Replay with FUZZ_SEED={seed}')
+	except pexpect.TIMEOUT:
+		hung = True
+		pytest.fail(f'kdb stopped responding after {ops!r}\n' +
+			    f'Replay with FUZZ_SEED={seed}')
+	finally:
+		# There is no point trying to resume a hung kernel
+		if not hung:
+			c.exit_kdb()
+
+	print(f'>>> {checked} command lines checked, {unchecked} could not be modelled')
+	record_property('checked', checked)
+	record_property('unchecked', unchecked)
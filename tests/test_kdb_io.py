@@ -1,6 +1,9 @@
 import kbuild
+import kdbedit
 import ktest
+import pexpect
 import pytest
+import random
 import re
 import time
 
@@ -17,6 +20,14 @@ INVALID3  = '\x1b[]'
 
 INVALID4  = '\x1b[1]'
 
+UNKNOWN = re.compile("Unknown[ a-z]*: '([^'\n]*)'")
+
+# test_editor_model() checks EDITOR_SEEDS * EDITOR_BATCHES * EDITOR_BATCH_SIZE
+# command lines but needs only one round trip per batch
+EDITOR_SEEDS = 8
+EDITOR_BATCHES = 10
+EDITOR_BATCH_SIZE = 25
+
 @pytest.fixture(scope="module")
 def kdb():
 	kbuild.config(kgdb=True)
@@ -285,6 +296,10 @@ def test_tab_complete(kdb):
 	try:
 		symbols = [ 'kdb_reboot ', 'kdb_rd ',
                             'kdb_register ', 'kdb_rm ' ]
+		# Make sure the host agrees these are valid completions
+		completions = kbuild.get_symbols().complete('kdb_r')
+		assert set([ s.strip() for s in symbols ]) <= set(completions)
+
 		c.send('kdb_r\t\t')
 		while symbols:
 			i = c.expect(symbols)
@@ -328,6 +343,19 @@ def test_tab_search(kdb):
 	finally:
 		c.exit_kdb()
 
+def check_model(c, keystrokes):
+	'''Type keystrokes (and enter) and compare kdb with the line editor model.
+
+	Returns the command that was executed.
+	'''
+	model = kdbedit.LineEditor(kbuild.get_symbols())
+	(expected,) = model.feed(keystrokes + '\r')
+
+	c.sendline(keystrokes)
+	cmd = UNKNOWN.search(c.expect_prompt(no_prompt=True)).group(1)
+	assert cmd == expected
+	return cmd
+
 def test_overflow(kdb):
 	'''Test that the line length is hard limited.
 
@@ -337,25 +365,19 @@ def test_overflow(kdb):
 	to capture everything and then filter that with a regular expression
 	so we only capture the Unknown command output.
 	'''
-	p = re.compile("Unknown[ a-z]*: '([^']*)'")
-
 	c = kdb.console.enter_kdb()
 	try:
-		c.sendline(f'{"x" * 198}yyy')
-		cmd = p.search(c.expect_prompt(no_prompt=True)).group(1)
+		cmd = check_model(c, f'{"x" * 198}yyy')
 		assert(cmd == ('x' * 198))
 
-		c.sendline(f'{"x" * 198}{LEFT}{LEFT}{LEFT}yyy')
-		cmd = p.search(c.expect_prompt(no_prompt=True)).group(1)
+		cmd = check_model(c, f'{"x" * 198}{LEFT}{LEFT}{LEFT}yyy')
 		assert(cmd == ('x' * 198))
 
-		c.sendline(f'{"x" * 198}{HOME}yyy')
-		cmd = p.search(c.expect_prompt(no_prompt=True)).group(1)
+		cmd = check_model(c, f'{"x" * 198}{HOME}yyy')
 		assert(cmd == ('x' * 198))
 
 		# Check if we make space we can insert characters
-		c.sendline(f'{"x" * 198}{HOME}{DEL * 3}yyyzzz')
-		cmd = p.search(c.expect_prompt(no_prompt=True)).group(1)
+		cmd = check_model(c, f'{"x" * 198}{HOME}{DEL * 3}yyyzzz')
 		assert(cmd == 'yyy' + ('x' * 195))
 	finally:
 		c.exit_kdb()
@@ -367,24 +389,72 @@ def test_overflow_and_tab(kdb):
 
 	Has same theory of operation as test_overflow().
 	'''
-	p = re.compile("Unknown[ a-z]*: '([^']*)'")
-
 	c = kdb.console.enter_kdb()
 	try:
 		# Test the test!
-		c.sendline(f"xxxx kdb_prom {'y' * 12}{HOME}{RIGHT * 13}\t")
-		cmd = p.search(c.expect_prompt(no_prompt=True)).group(1)
+		cmd = check_model(c, f"xxxx kdb_prom {'y' * 12}{HOME}{RIGHT * 13}\t")
 		assert(cmd == 'xxxx kdb_prompt_str yyyyyyyyyyyy')
 
 		# Tab complete during overflow does nothing
-		c.sendline(f"xxxx kdb_prom {'y' * 199}{HOME}{RIGHT * 13}\t")
-		cmd = p.search(c.expect_prompt(no_prompt=True)).group(1)
+		cmd = check_model(c, f"xxxx kdb_prom {'y' * 199}{HOME}{RIGHT * 13}\t")
 		assert(cmd == f"xxxx kdb_prom {'y' * (198-14)}")
 
 		# Tab complete partially completes until it hit the limit
-		c.sendline(f"xxxx kdb_prom {'y' * 199}{HOME}{RIGHT * 14}{DEL * 2}{LEFT}\t")
-		cmd = p.search(c.expect_prompt(no_prompt=True)).group(1)
+		cmd = check_model(c, f"xxxx kdb_prom {'y' * 199}{HOME}{RIGHT * 14}{DEL * 2}{LEFT}\t")
 		assert(cmd == f"xxxx kdb_prompt {'y' * (198-16)}")
+	finally:
+		c.exit_kdb()
+
+def drain(c):
+	'''Consume (without waiting) whatever output has already arrived.
 
+	expect() cannot do this because matching pexpect.TIMEOUT leaves the
+	buffer in place (so before would report the same output again).
+	Anything an earlier expect() read past its match is already in the
+	buffer so we must take that first.
+	'''
+	output = c.buffer
+	c.buffer = ''
+	try:
+		while True:
+			output += c.read_nonblocking(4096, timeout=0)
+	except pexpect.TIMEOUT:
+		pass
+	return output
+
+@pytest.mark.parametrize('seed', range(EDITOR_SEEDS))
+def test_editor_model(kdb, seed):
+	'''Check random editing sequences against the line editor model.
+
+	Each batch of command lines is typed back-to-back and the commands
+	kdb reports are compared with the model in one go.
+	'''
+	rng = random.Random(seed)
+	model = kdbedit.LineEditor(kbuild.get_symbols())
+
+	c = kdb.console.enter_kdb()
+	try:
+		for batch in range(EDITOR_BATCHES):
+			(expected, sent, output) = ([], [], '')
+			for i in range(EDITOR_BATCH_SIZE):
+				keys = ''.join(kdbedit.random_keystrokes(
+						rng, rng.randint(1, 20), history=False)) + '\r'
+				for cmd in model.feed(keys):
+					if model.unknown(cmd):
+						expected.append(cmd)
+						sent.append(keys)
+
+				c.send(keys)
+				# Keep reading so kdb never stalls waiting for us
+				output += drain(c).replace('\r', '')
+			output += c.expect_prompt(no_prompt=True)
+
+			# An empty line repeats the previous command (which reports
+			# an empty unknown command)
+			actual = [ cmd for cmd in UNKNOWN.findall(output) if cmd ]
+
+			for (keys, e, a) in zip(sent, expected, actual):
+				assert a == e, f'Unexpected result from {keys!r} (seed {seed}, batch {batch})'
+			assert len(actual) == len(expected)
 	finally:
 		c.exit_kdb()
@@ -0,0 +1,165 @@
+import collections
+import kbuild
+import ktest
+import os
+import pytest
+import re
+import time
+
+# Soak tests run until they have completed a number of cycles or for a
+# fixed duration. They only run when SOAK is set:
+#
+#   SOAK=10000     run 10000 enter/exit cycles
+#   SOAK=30m       run for 30 minutes (s, m and h suffixes are supported)
+#
+# SOAK_LOAD selects the background load as a comma separated list of
+# kind[:workers][@rate] (see ktest.parse_load()), for example
+# SOAK_LOAD=io:2,fork@500.
+pytestmark = pytest.mark.skipif('SOAK' not in os.environ,
+		reason = 'Set SOAK to run the soak tests')
+
+def get_limits():
+	'''Returns a (max_cycles, max_seconds) tuple.'''
+	soak = os.environ['SOAK']
+	m = re.fullmatch('([0-9]+)([smh])', soak)
+	if m:
+		return (None, int(m.group(1)) * { 's': 1, 'm': 60, 'h': 3600 }[m.group(2)])
+	try:
+		return (int(soak), None)
+	except ValueError:
+		return (1000, None)
+
+def get_load():
+	return os.environ.get('SOAK_LOAD', 'io').split(',')
+
+class Histogram(object):
+	'''Latency histogram with power-of-two millisecond buckets.'''
+	def __init__(self, name):
+		self.name = name
+		self.buckets = collections.Counter()
+		self.samples = []
+
+	def add(self, seconds):
+		self.samples.append(seconds)
+		bucket = 1
+		while bucket < seconds * 1000:
+			bucket *= 2
+		self.buckets[bucket] += 1
+
+	def report(self):
+		n = len(self.samples)
+		if not n:
+			return
+		print(f'>>> {self.name}: {n} cycles, min {min(self.samples)*1000:.1f}ms, ' +
+		      f'mean {sum(self.samples)/n*1000:.1f}ms, max {max(self.samples)*1000:.1f}ms')
+		scale = max(self.buckets.values()) / 50
+		for (bucket, count) in sorted(self.buckets.items()):
+			bar = '#' * max(1, int(count / scale))
+			print(f'>>> {bucket:8}ms | {bar} {count}')
+
+def soak(name, cycle, **channels):
+	'''Repeatedly run cycle() until the soak limits are reached.
+
+	cycle() must return a tuple of (entry, exit) latencies, which are
+	written to <name>-latency.csv (in the kernel build directory). A
+	rolling window of output is kept for each of the channels and, if
+	anything goes wrong, they are written to <name>-failure.txt before
+	the failure is propagated.
+	'''
+	(max_cycles, max_seconds) = get_limits()
+	histograms = (Histogram('entry'), Histogram('exit'))
+	transcripts = {}
+	for (label, channel) in channels.items():
+		transcripts[label] = ktest.Transcript()
+		channel.logfile_read = transcripts[label]
+
+	start = time.monotonic()
+	n = 0
+	try:
+		with open(f'{name}-latency.csv', 'w') as f:
+			print('cycle,entry,exit', file=f)
+			while (max_cycles is None or n < max_cycles) and \
+			      (max_seconds is None or time.monotonic() - start < max_seconds):
+				latencies = cycle()
+				for (h, t) in zip(histograms, latencies):
+					h.add(t)
+				print('{},{:.6f},{:.6f}'.format(n, *latencies), file=f, flush=True)
+				n += 1
+				if n % 100 == 0:
+					print(f'>>> {n} cycles completed')
+	except BaseException:
+		with open(f'{name}-failure.txt', 'w') as f:
+			for (label, transcript) in transcripts.items():
+				f.write(f'===== {label} =====\n{transcript}\n')
+		print(f'>>> Failed after {n} cycles, last output saved to {name}-failure.txt')
+		raise
+	finally:
+		for channel in channels.values():
+			channel.logfile_read = None
+		for h in histograms:
+			h.report()
+
+@pytest.fixture(scope="module")
+def build():
+	kbuild.config(kgdb=True)
+	kbuild.build()
+
+@pytest.fixture()
+def kdb(build):
+	qemu = ktest.qemu()
+
+	console = qemu.console
+	console.expect_boot()
+	console.expect_busybox()
+
+	yield qemu
+
+	qemu.close()
+
+@pytest.fixture()
+def kgdb(build):
+	qemu = ktest.qemu(second_uart=True, gdb=True)
+
+	qemu.console.expect_boot()
+	qemu.console.expect_busybox()
+
+	qemu.console.sysrq('g')
+	qemu.debug.connect_to_target()
+	qemu.debug.send('set style enabled off\r')
+	qemu.exit_gdb(shell=True)
+
+	yield qemu
+
+	qemu.close()
+
+def test_kdb_soak(kdb):
+	'''Repeatedly enter and exit kdb under load.'''
+	c = kdb.console
+
+	def cycle():
+		t0 = time.monotonic()
+		c.enter_kdb()
+		t1 = time.monotonic()
+		c.exit_kdb()
+		return (t1 - t0, time.monotonic() - t1)
+
+	with c.load(*get_load()):
+		try:
+			soak('kdb-soak', cycle, console=c)
+		finally:
+			if c.inside_kdb():
+				c.exit_kdb()
+
+def test_kgdb_soak(kgdb):
+	'''Repeatedly enter and exit kgdb under load.'''
+	c = kgdb.console
+
+	def cycle():
+		t0 = time.monotonic()
+		kgdb.enter_gdb()
+		t1 = time.monotonic()
+		kgdb.exit_gdb(shell=True)
+		return (t1 - t0, time.monotonic() - t1)
+
+	with c.load(*get_load()):
+		soak('kgdb-soak', cycle, console=c, gdb=kgdb.debug)
@@ -0,0 +1,109 @@
+import difflib
+import kbuild
+import ktest
+import os
+import pytest
+import re
+import warnings
+
+# These tests take a long time so they only run when STRESS is set. If
+# STRESS is a number then it sets the number of iterations for each test.
+pytestmark = pytest.mark.skipif('STRESS' not in os.environ,
+		reason = 'Set STRESS to run the console stress tests')
+
+def get_iterations():
+	try:
+		return max(1, int(os.environ['STRESS']))
+	except ValueError:
+		return 1
+
+COMMANDS = (
+	'md kdb_printf 512',
+	'ps A',
+	'bta',
+	'dmesg',
+)
+
+@pytest.fixture(scope="module")
+def kdb():
+	kbuild.config(kgdb=True)
+	kbuild.build()
+
+	qemu = ktest.qemu()
+
+	console = qemu.console
+	console.expect_boot()
+	console.expect_busybox()
+
+	# Disable the pagers so the output is sent as fast as kdb can
+	# produce it
+	c = console.enter_kdb()
+	try:
+		c.sendline('set LINES 10000')
+		c.expect_prompt()
+		c.sendline('set BTAPROMPT 0')
+		c.expect_prompt()
+	finally:
+		c.exit_kdb()
+
+	yield qemu
+
+	qemu.close()
+
+@pytest.mark.parametrize('cmd', COMMANDS)
+def test_throughput(kdb, cmd, record_property):
+	'''Measure how quickly kdb can get output to the host.'''
+	c = kdb.console.enter_kdb()
+	try:
+		(nchars, seconds) = (0, 0.0)
+		for i in range(get_iterations()):
+			(n, t) = c.measure_command(cmd)
+			nchars += n
+			seconds += t
+			# measure_command() consumed the prompt
+			c.expect_prompt(no_prompt=True)
+	finally:
+		c.exit_kdb()
+
+	rate = nchars / seconds
+	print(f'>>> {cmd}: {nchars} chars in {seconds:.2f}s ({rate:.0f} chars/s)')
+	record_property('chars_per_second', int(rate))
+
+@pytest.mark.parametrize('cmd', COMMANDS)
+def test_input_during_output(kdb, cmd, record_property):
+	'''Type whilst kdb is producing output and check nothing is lost.
+
+	The injected characters should appear, intact, as the next command
+	once the output is complete. Lost and reordered characters are
+	reported (and recorded in the junit output) rather than failing the
+	test. The injected tags are ASCII so each character is one byte on
+	the wire.
+	'''
+	p = re.compile("Unknown[ a-z]*: '([^']*)'")
+	(sent_chars, dropped, extra) = (0, 0, 0)
+
+	c = kdb.console.enter_kdb()
+	try:
+		for i in range(get_iterations()):
+			sent = ktest.unique_tag('INJECT')
+			c.measure_command(cmd, inject=sent)
+			c.sendline()
+			m = p.search(c.expect_prompt(no_prompt=True))
+			received = m.group(1) if m else ''
+
+			matcher = difflib.SequenceMatcher(None, sent, received)
+			matched = sum([ b.size for b in matcher.get_matching_blocks() ])
+			sent_chars += len(sent)
+			dropped += len(sent) - matched
+			extra += len(received) - matched
+			if sent != received:
+				print(f'>>> Sent {sent} but kdb saw {received}')
+	finally:
+		c.exit_kdb()
+
+	print(f'>>> {cmd}: {dropped} of {sent_chars} characters dropped, ' +
+	      f'{extra} characters reordered or corrupted')
+	record_property('dropped', dropped)
+	record_property('reordered', extra)
+	if dropped or extra:
+		warnings.warn(f'Console input was damaged during {cmd}')
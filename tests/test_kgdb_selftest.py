@@ -91,18 +91,7 @@ def test_kgdbts_V1S10000(kernel):
 	   fg # and hit control-c
 	   fg # and hit control-c
 	'''
-	kernel.console.sendline('n=$((`nproc` + 1))')
-	kernel.console.sendline('for i in `seq $n`')
-	kernel.console.sendline('do')
-	kernel.console.sendline('while [ 1 ] ; do find / > /dev/null 2>&1 ; done &')
-	kernel.console.sendline('done')
-	kernel.console.expect_prompt()
-	kernel.console.sendline('jobs | tee j')
-	kernel.console.expect_prompt()
-	kernel.console.sendline('[ `cat j | wc -l` -eq $n ] && [ $n -gt 1 ] && echo OK || echo FAILED')
-	choice = kernel.console.expect(['FAILED', 'OK'])
-	assert choice
-	kernel.console.expect_prompt()
+	load = kernel.console.load('open').start()
 
 	kernel.console.sendline('echo kgdbts=V1S10000 > /sys/module/kgdbts/parameters/kgdbts')
 	#kernel.console.sendline('echo kgdbts=V1S1000 > /sys/module/kgdbts/parameters/kgdbts')
@@ -119,8 +108,7 @@ def test_kgdbts_V1S10000(kernel):
 		assert(choice <= KGDBTS_RUNNING)
 
 	kernel.console.expect_prompt(no_history=True)
-	kernel.console.sendline('for i in `seq $n`; do kill %$i; done; sleep 1')
-	kernel.console.expect_prompt()
+	load.stop()
 
 @pytest.mark.xfail(condition = (kbuild.get_arch() == 'arm') and (kbuild.get_version() < (6, 7)),
 		   reason = 'Hangs during concurrency tests', run = True)
@@ -140,18 +128,7 @@ def test_kgdbts_V1F1000(kernel):
 	   echo kgdbts=V1F1000 > /sys/module/kgdbts/parameters/kgdbts
 	   fg # and hit control-c
 	'''
-	kernel.console.sendline('n=$((`nproc` + 1))')
-	kernel.console.sendline('for i in `seq $n`')
-	kernel.console.sendline('do')
-	kernel.console.sendline('while [ 1 ] ; do date > /dev/null 2>&1 ; done &')
-	kernel.console.sendline('done')
-	kernel.console.expect_prompt()
-	kernel.console.sendline('jobs | tee j')
-	kernel.console.expect_prompt()
-	kernel.console.sendline('[ `cat j | wc -l` -eq $n ] && [ $n -gt 1 ] && echo OK || echo FAILED')
-	choice = kernel.console.expect(['FAILED', 'OK'])
-	assert choice
-	kernel.console.expect_prompt()
+	load = kernel.console.load('fork').start()
 
 	kernel.console.sendline('echo kgdbts=V1F1000 > /sys/module/kgdbts/parameters/kgdbts')
 	choice = kernel.console.expect(['ERROR', 'Registered I/O driver kgdbts'])
@@ -167,5 +144,4 @@ def test_kgdbts_V1F1000(kernel):
 		assert(choice <= KGDBTS_RUNNING)
 
 	kernel.console.expect_prompt(no_history=True)
-	kernel.console.sendline('for i in `seq $n`; do kill %$i; done; sleep 1')
-	kernel.console.expect_prompt()
+	load.stop()
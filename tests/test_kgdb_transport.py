@@ -0,0 +1,63 @@
+import kbuild
+import ktest
+import pytest
+import time
+
+# Big enough that the transfer dominates the fixed cost of the gdb
+# round trips but small enough to complete promptly on a TCG UART.
+DUMP_SIZE = 64 * 1024
+
+@pytest.fixture(scope="module")
+def build():
+	kbuild.config(kgdb=True)
+	kbuild.build()
+
+def launch(transport):
+	qemu = ktest.qemu(second_uart=True, gdb=True, transport=transport)
+
+	qemu.console.expect_boot()
+	qemu.console.expect_busybox()
+
+	qemu.console.sysrq('g')
+	qemu.debug.connect_to_target()
+
+	return qemu
+
+@pytest.mark.parametrize('transport', ('uart', 'virtio'))
+def test_transport_nop(build, transport):
+	'''Check we can stop and resume the kernel using each transport.'''
+	qemu = launch(transport)
+	try:
+		qemu.exit_gdb(shell=True)
+		qemu.enter_gdb()
+		qemu.exit_gdb(shell=True)
+	finally:
+		qemu.close()
+
+def test_memory_dump_throughput(build, record_property):
+	'''Compare gdb memory read throughput for each transport.
+
+	This is a benchmark rather than a pass/fail test. The results are
+	printed and also recorded as properties in the junit output.
+	'''
+	results = {}
+
+	for transport in ('uart', 'virtio'):
+		qemu = launch(transport)
+		try:
+			gdb = qemu.debug
+			start = time.monotonic()
+			gdb.sendline('dump binary memory /dev/null ' +
+				     '(char *) &_stext ' +
+				     f'((char *) &_stext) + {DUMP_SIZE}')
+			gdb.expect_prompt()
+			elapsed = time.monotonic() - start
+		finally:
+			qemu.close()
+
+		results[transport] = DUMP_SIZE / elapsed
+		record_property(f'{transport}_bytes_per_second', int(results[transport]))
+
+	for (transport, rate) in results.items():
+		print(f'>>> {transport:8} {rate / 1024:10.1f} KiB/s')
+	print(f">>> virtio is {results['virtio'] / results['uart']:.1f}x faster than uart")